@@ -0,0 +1,45 @@
+# ws消息编解码的基准，使用data/onebot_frames.jsonl中记录的帧，比较各个已安装的json实现
+# 在仓库根目录下运行：python -m benchmark.codec
+import os
+import time
+
+from extended_framework.lolibot.codec import available_codecs
+
+ROUNDS = 200
+
+_frames_path = os.path.join(os.path.dirname(__file__), 'data', 'onebot_frames.jsonl')
+
+
+def _load_frames() -> list[str]:
+    with open(_frames_path, encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+# 与send_msg发出的api调用结构一致
+def _actions(count: int) -> list[dict]:
+    return [{
+        'action': 'send_msg_async',
+        'params': {'message_type': 'group', 'group_id': 123456789,
+                   'message': [{'type': 'reply', 'data': {'id': str(1987000000 + i)}},
+                               {'type': 'text', 'data': {'text': f'第{i}条回复，今天天气不错'}}]},
+        'echo': i,
+    } for i in range(count)]
+
+
+def _timeit(func, items: list) -> float:
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        for item in items:
+            func(item)
+    return (time.perf_counter() - start) * 1e9 / (ROUNDS * len(items))
+
+
+if __name__ == '__main__':
+    text_frames = _load_frames()
+    bytes_frames = [frame.encode() for frame in text_frames]
+    actions = _actions(len(text_frames))
+    print(f'{len(text_frames)} recorded frames x {ROUNDS} rounds, ns/frame')
+    print(f'{"codec":<8} {"loads str":>10} {"loads bytes":>12} {"dumps bytes":>12} {"dumps str":>10}')
+    for name, codec in available_codecs().items():
+        print(f'{name:<8} {_timeit(codec.loads, text_frames):>10.0f} {_timeit(codec.loads, bytes_frames):>12.0f}'
+              f' {_timeit(codec.dumps, actions):>12.0f} {_timeit(codec.dumps_text, actions):>10.0f}')
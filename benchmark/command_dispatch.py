@@ -0,0 +1,88 @@
+# 命令分发的微基准，比较原先逐个别名startswith的线性扫描与前缀树匹配
+# 在仓库根目录下运行：python -m benchmark.command_dispatch
+import random
+import string
+import timeit
+
+from extended_framework.lolibot import Bot, current_bot
+from extended_framework.lolibot.message import Message, Text
+from extended_framework.command import _AliasTrie, _handle_command, on_command, Permission
+
+_CHARS = string.ascii_lowercase + '查询天气抽卡签到帮助设置图片翻译'
+_CHAT = ['今天吃什么', 'hello everyone', '哈哈哈哈哈哈', '有没有人一起打游戏', '[图片]', 'ok']
+
+
+def _gen_aliases(count: int, rnd: random.Random) -> list[str]:
+    trie = _AliasTrie()
+    res = []
+    while len(res) < count:
+        alias = ''.join(rnd.choice(_CHARS) for _ in range(rnd.randint(2, 6)))
+        if trie.conflict(alias) is None:
+            trie.insert(alias, alias)
+            res.append(alias)
+    return res
+
+
+def _linear_match(alias_to_main_name: dict[str, str], text: str) -> str | None:
+    for alias, main_name in alias_to_main_name.items():
+        if text.startswith(alias):
+            return main_name
+    return None
+
+
+class _FakeEvent:
+    def __init__(self, text: str):
+        self.message = Message(Text(text))
+
+
+def bench(count: int, number: int = 20000) -> None:
+    rnd = random.Random(count)
+    aliases = _gen_aliases(count, rnd)
+    alias_to_main_name = {alias: alias for alias in aliases}
+    trie = _AliasTrie()
+    for alias in aliases:
+        trie.insert(alias, alias)
+
+    hits = [f'{rnd.choice(aliases)} 参数' for _ in range(100)]
+    misses = [rnd.choice(_CHAT) for _ in range(100)]
+
+    def run(match, texts):
+        def inner():
+            for text in texts:
+                match(text)
+
+        return timeit.timeit(inner, number=number // len(texts)) / number * 1e9
+
+    linear = lambda text: _linear_match(alias_to_main_name, text)
+    print(f'{count:>5} aliases | hit:  linear {run(linear, hits):>9.0f} ns  trie {run(trie.match, hits):>6.0f} ns'
+          f' | miss: linear {run(linear, misses):>9.0f} ns  trie {run(trie.match, misses):>6.0f} ns')
+
+
+def bench_handle_command(count: int, number: int = 20000) -> None:
+    # 通过真实的注册与分发路径测量非命令消息的开销，权限检查恒为False以避免真正执行命令
+    rnd = random.Random(count)
+    bot = Bot(f'bench{count}', f'/bench{count}')
+    token = current_bot.set(bot)
+    try:
+        deny = Permission(lambda event: False)
+        for alias in _gen_aliases(count, rnd):
+            on_command(f'#{bot.name}_{alias}', [alias], permission=deny)(lambda event: None)
+
+        events = [_FakeEvent(rnd.choice(_CHAT)) for _ in range(100)]
+
+        def inner():
+            for event in events:
+                event.message.text = None
+                _handle_command(event)
+
+        per_call = timeit.timeit(inner, number=number // len(events)) / number * 1e9
+    finally:
+        current_bot.reset(token)
+    print(f'{count:>5} aliases | _handle_command on non-command message: {per_call:>6.0f} ns')
+
+
+if __name__ == '__main__':
+    for n in (10, 100, 1000):
+        bench(n)
+    for n in (10, 100, 1000):
+        bench_handle_command(n)
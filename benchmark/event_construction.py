@@ -0,0 +1,94 @@
+# MessageEvent构造开销的基准，比较原先的即时构造方式与当前的延迟构造方式
+# 在仓库根目录下运行：python -m benchmark.event_construction
+import logging
+import time
+import tracemalloc
+
+from extended_framework.lolibot.logger import setup_logging
+from extended_framework.lolibot.message import MessageEvent
+
+EVENTS = 100_000
+
+
+def _payload(i: int) -> dict:
+    text = f'第{i}条消息 hello'
+    return {
+        'self_id': 10001, 'user_id': 20000 + i % 500, 'time': 1700000000 + i, 'message_id': i,
+        'message_seq': i, 'real_id': i, 'message_type': 'group', 'sub_type': 'normal',
+        'sender': {'user_id': 20000 + i % 500, 'nickname': f'user{i % 500}', 'card': '', 'role': 'member'},
+        'raw_message': text, 'font': 14, 'message_format': 'array', 'post_type': 'message',
+        'group_id': 30000 + i % 20,
+        'message': [{'type': 'at', 'data': {'qq': '10001'}}, {'type': 'text', 'data': {'text': text}}],
+    }
+
+
+# 下面是原先实现的复刻，用于对比
+class _LegacySender:
+    def __init__(self, source: dict):
+        self.group_id = source.get('group_id')
+        self.role = source['sender']['role'] if self.group_id else source['sub_type']
+        self.user_id = source['sender']['user_id']
+        self.nickname = source['sender']['nickname']
+        self.card = source['sender']['card']
+
+    def __str__(self):
+        group_info = f'group_id={self.group_id}' if self.group_id else 'private'
+        return f"Sender({group_info}, role:{self.role}, user_id:{self.user_id}, nickname:{self.nickname}{', card:' + self.card if self.card else ''})"
+
+
+class _LegacySegment(dict):
+    def __init__(self, source: dict):
+        super().__init__(source)
+        self.type = self['type']
+        self.data = self['data']
+
+    def __str__(self):
+        return f"{self.type}({self.data})"
+
+
+class _LegacyMessage:
+    def __init__(self, *args):
+        self.content = list(args)
+        self.text = None
+
+    def __str__(self):
+        return "[" + ", ".join(str(segment) for segment in self.content) + "]"
+
+
+class _LegacyMessageEvent:
+    def __init__(self, source: dict):
+        if source['message_format'] != 'array':
+            raise Exception
+        self.self_id = source['self_id']
+        self.message_id = source['message_id']
+        self.sender = _LegacySender(source)
+        self.message = _LegacyMessage(*list(_LegacySegment(item) for item in source['message']))
+        _ = f'Message id {self.message_id} received from {self.sender}:\n{self.message}'  # 原先每条消息都会格式化日志
+
+
+def measure(name: str, factory, payloads: list[dict]) -> None:
+    start = time.perf_counter()
+    for payload in payloads:
+        factory(payload)
+    elapsed = time.perf_counter() - start
+
+    # 分别统计保留全部事件时的常驻内存和构造过程中的内存峰值
+    tracemalloc.start()
+    events = [factory(payload) for payload in payloads]
+    retained, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocs = sum(stat.count for stat in snapshot.statistics('filename'))
+    del events
+
+    print(f'{name:<8} {elapsed * 1e9 / len(payloads):>8.0f} ns/event  retained {retained / 2 ** 20:>7.1f} MiB'
+          f'  peak {peak / 2 ** 20:>7.1f} MiB  live blocks {allocs:>9}')
+
+
+if __name__ == '__main__':
+    setup_logging(logging.WARNING)  # 只测量构造本身，不输出日志
+
+    payloads = [_payload(i) for i in range(EVENTS)]
+    print(f'{EVENTS} events (payload dicts excluded from measurements)')
+    measure('legacy', _LegacyMessageEvent, payloads)
+    measure('current', MessageEvent, payloads)
@@ -0,0 +1,207 @@
+# 模拟的onebot协议端，以universal反向ws连接到bot的端点，按设定的速率和组成推送合成的消息事件
+# 收到api调用后按设定的延迟自动回复，并统计从发出命令到收到bot回复的延迟
+# 可以在压测脚本中直接使用，也可以单独运行在另一个进程中，避免与被测的服务争抢cpu：
+# python -m benchmark.fake_client --url ws://127.0.0.1:18082/ --rate 2000 --duration 10
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+
+from typing import Callable, Dict, List
+
+import aiohttp
+
+
+class EventMix:
+    # command_ratio为命令消息的比例，segments为非命令消息中各类消息段的权重
+    def __init__(self, *, groups: int = 50, users: int = 500, private_ratio: float = 0.05,
+                 command_ratio: float = 0.2, commands: List[str] = ('ping', 'echo 你好'),
+                 segments: Dict[str, float] | None = None, seed: int = 0):
+        self.groups = groups
+        self.users = users
+        self.private_ratio = private_ratio
+        self.command_ratio = command_ratio
+        self.commands = list(commands)
+        self.segments = segments or {'text': 8, 'at': 1, 'face': 1, 'image': 1, 'reply': 1}
+        self._rnd = random.Random(seed)
+
+    def _segment(self, kind: str, message_id: int, self_id: int) -> dict:
+        rnd = self._rnd
+        if kind == 'text':
+            return {'type': 'text', 'data': {'text': rnd.choice(['哈哈哈哈', '今天吃什么', '有人打游戏吗', 'ok', '草'])}}
+        if kind == 'at':
+            qq = self_id if rnd.random() < 0.3 else rnd.randrange(10 ** 8, 10 ** 9)
+            return {'type': 'at', 'data': {'qq': str(qq)}}
+        if kind == 'face':
+            return {'type': 'face', 'data': {'id': str(rnd.randrange(300))}}
+        if kind == 'image':
+            return {'type': 'image', 'data': {'file': f'{message_id:032X}.jpg', 'summary': '', 'sub_type': 0,
+                                              'url': f'https://multimedia.nt.qq.com.cn/download?fileid={message_id}',
+                                              'file_size': str(rnd.randrange(10 ** 4, 10 ** 6))}}
+        return {'type': 'reply', 'data': {'id': str(max(1, message_id - rnd.randrange(1, 100)))}}
+
+    def event(self, message_id: int, self_id: int) -> tuple[dict, bool]:
+        rnd = self._rnd
+        is_command = rnd.random() < self.command_ratio
+        if is_command:
+            text = rnd.choice(self.commands)
+            message = [{'type': 'text', 'data': {'text': text}}]
+        else:
+            kinds = rnd.choices(list(self.segments), weights=list(self.segments.values()), k=rnd.randint(1, 3))
+            message = [self._segment(kind, message_id, self_id) for kind in kinds]
+            text = ' '.join(seg['data']['text'] for seg in message if seg['type'] == 'text')
+
+        user_id = 10 ** 9 + rnd.randrange(self.users)
+        payload = {
+            'self_id': self_id, 'user_id': user_id, 'time': int(time.time()), 'message_id': message_id,
+            'message_seq': message_id, 'real_id': message_id, 'raw_message': text, 'font': 14,
+            'message': message, 'message_format': 'array', 'post_type': 'message',
+        }
+        if rnd.random() < self.private_ratio:
+            payload.update(message_type='private', sub_type='friend', target_id=user_id,
+                           sender={'user_id': user_id, 'nickname': f'user{user_id % 1000}', 'card': ''})
+        else:
+            payload.update(message_type='group', sub_type='normal', group_id=10 ** 8 + rnd.randrange(self.groups),
+                           sender={'user_id': user_id, 'nickname': f'user{user_id % 1000}', 'card': '',
+                                   'role': 'member'})
+        return payload, is_command
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class FakeOneBotClient:
+    # latency为回复每个api调用前等待的秒数，可以传入函数来生成随机延迟
+    def __init__(self, url: str, *, self_id: int = 10001, latency: float | Callable[[], float] = 0.0,
+                 mix: EventMix | None = None):
+        self.url = url
+        self.self_id = self_id
+        self.latency = latency
+        self.mix = mix or EventMix()
+
+        self._ws: aiohttp.ClientWebSocketResponse | None = None
+        self._message_ids = itertools.count(1)
+        self._result_ids = itertools.count(10 ** 9)
+        self._pending: Dict[int, float] = {}  # 等待回复的命令消息id -> 发出时间
+        self._tasks: set = set()
+
+        # 统计数据
+        self.sent = 0
+        self.commands = 0
+        self.actions: Dict[str, int] = {}
+        self.reply_latencies: List[float] = []
+
+    def _api_result(self, action: str, params: dict) -> dict:
+        if action in ('send_msg', 'send_msg_async', 'send_group_msg', 'send_private_msg'):
+            return {'message_id': next(self._result_ids)}
+        if action in ('get_msg', 'get_msg_async'):
+            payload, _ = self.mix.event(int(params.get('message_id', 0)), self.self_id)
+            return payload
+        if action == 'get_login_info':
+            return {'user_id': self.self_id, 'nickname': 'fake'}
+        return {}
+
+    def _record_reply(self, params: dict) -> None:
+        # bot的回复默认引用原消息，根据引用的id找到对应的命令
+        for seg in params.get('message', ()):
+            if seg.get('type') == 'reply' and (start := self._pending.pop(int(seg['data']['id']), None)) is not None:
+                self.reply_latencies.append(time.perf_counter() - start)
+                return
+
+    async def _answer(self, frame: dict) -> None:
+        action, params = frame.get('action'), frame.get('params') or {}
+        self.actions[action] = self.actions.get(action, 0) + 1
+        if action in ('send_msg', 'send_msg_async'):
+            self._record_reply(params)
+        latency = self.latency() if callable(self.latency) else self.latency
+        if latency:
+            await asyncio.sleep(latency)
+        await self._ws.send_str(json.dumps({'status': 'ok', 'retcode': 0, 'data': self._api_result(action, params),
+                                            'message': '', 'wording': '', 'echo': frame.get('echo')},
+                                           ensure_ascii=False))
+
+    async def _receive(self) -> None:
+        async for msg in self._ws:
+            if msg.type not in (aiohttp.WSMsgType.TEXT, aiohttp.WSMsgType.BINARY):
+                break
+            task = asyncio.create_task(self._answer(json.loads(msg.data)))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def push(self) -> None:
+        message_id = next(self._message_ids)
+        payload, is_command = self.mix.event(message_id, self.self_id)
+        if is_command:
+            self.commands += 1
+            self._pending[message_id] = time.perf_counter()
+        await self._ws.send_str(json.dumps(payload, ensure_ascii=False))
+        self.sent += 1
+
+    # 以rate条每秒的速率推送duration秒，结束后再等待settle秒接收剩余的回复，返回统计结果
+    async def run(self, rate: float, duration: float, settle: float = 2.0) -> dict:
+        async with aiohttp.ClientSession() as session:
+            headers = {'X-Client-Role': 'Universal', 'X-Self-ID': str(self.self_id)}
+            async with session.ws_connect(self.url, headers=headers, max_msg_size=0) as ws:
+                self._ws = ws
+                receiver = asyncio.create_task(self._receive())
+                await ws.send_str(json.dumps({'time': int(time.time()), 'self_id': self.self_id,
+                                              'post_type': 'meta_event', 'meta_event_type': 'lifecycle',
+                                              'sub_type': 'connect'}))
+
+                # 每个tick补发落后的事件，速率超出处理能力时实际速率会低于设定值
+                tick = 0.01
+                start = time.perf_counter()
+                while (elapsed := time.perf_counter() - start) < duration:
+                    for _ in range(int(elapsed * rate) - self.sent):
+                        await self.push()
+                    await asyncio.sleep(tick)
+                elapsed = time.perf_counter() - start
+
+                deadline = time.perf_counter() + settle
+                while self._pending and time.perf_counter() < deadline:
+                    await asyncio.sleep(0.05)
+                receiver.cancel()
+                await asyncio.gather(receiver, *self._tasks, return_exceptions=True)
+
+        return self.report(elapsed)
+
+    def report(self, elapsed: float) -> dict:
+        return {
+            'sent': self.sent,
+            'events_per_sec': self.sent / elapsed if elapsed else 0.0,
+            'commands': self.commands,
+            'replies': len(self.reply_latencies),
+            'unanswered': len(self._pending),
+            'p50_ms': percentile(self.reply_latencies, 0.5) * 1000,
+            'p99_ms': percentile(self.reply_latencies, 0.99) * 1000,
+            'actions': self.actions,
+        }
+
+
+def _parse_args(argv: List[str] | None = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Fake OneBot v11 reverse-websocket client.')
+    parser.add_argument('--url', default='ws://127.0.0.1:18082/')
+    parser.add_argument('--rate', type=float, default=1000, help='events per second')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--latency-ms', type=float, default=5, help='delay before answering each api call')
+    parser.add_argument('--groups', type=int, default=50)
+    parser.add_argument('--users', type=int, default=500)
+    parser.add_argument('--command-ratio', type=float, default=0.2)
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args(argv)
+
+
+def client_from_args(args: argparse.Namespace) -> FakeOneBotClient:
+    mix = EventMix(groups=args.groups, users=args.users, command_ratio=args.command_ratio, seed=args.seed)
+    return FakeOneBotClient(args.url, latency=args.latency_ms / 1000, mix=mix)
+
+
+if __name__ == '__main__':
+    _args = _parse_args()
+    print(json.dumps(asyncio.run(client_from_args(_args).run(_args.rate, _args.duration)), ensure_ascii=False))
@@ -0,0 +1,79 @@
+# 端到端压测，在当前进程中启动Server和一个加载了load_plugin的Bot，用fake_client推送事件并统计吞吐、回复延迟和内存增长
+# 在仓库根目录下运行：python -m benchmark.load --rate 2000 --duration 10
+# 加上--client-process时协议端运行在单独的进程中，测得的吞吐不包含模拟协议端本身的开销
+import asyncio
+import gc
+import json
+import logging
+import os
+import resource
+import sys
+
+import uvicorn
+
+from extended_framework.command import handle_msg
+from extended_framework.lolibot import Bot, Server, metrics
+from extended_framework.lolibot.logger import setup_logging
+
+from .fake_client import _parse_args, client_from_args
+
+
+def _rss_mib() -> float:
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except OSError:  # 非linux系统只能读取峰值
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (2 ** 20 if sys.platform == 'darwin' else 2 ** 10)
+
+
+async def _run_client_process(argv: list[str]) -> dict:
+    process = await asyncio.create_subprocess_exec(sys.executable, '-m', 'benchmark.fake_client', *argv,
+                                                   stdout=asyncio.subprocess.PIPE)
+    stdout, _ = await process.communicate()
+    return json.loads(stdout.decode().strip().splitlines()[-1])
+
+
+async def main(argv: list[str]) -> None:
+    client_process = '--client-process' in argv
+    argv = [arg for arg in argv if arg != '--client-process']
+    args = _parse_args(argv)
+    port = int(args.url.rsplit(':', 1)[1].split('/')[0])
+
+    setup_logging(logging.WARNING)  # 只测量处理本身，不输出每条消息的日志
+
+    server = Server()
+    bot = Bot('bench', '/').load_plugins_from_list([('bench', 'benchmark.load_plugin')], warm_imports=False)
+    bot.handle_msg_funcs.append(handle_msg())
+    bot.send_scheduler = None  # 不限流，否则测得的延迟主要是限流的等待时间
+    server.add_bot(bot)
+
+    config = uvicorn.Config(server._server_app, host='127.0.0.1', port=port, log_config=None, log_level='warning')
+    service = uvicorn.Server(config)
+    serving = asyncio.create_task(service.serve())
+    while not service.started:
+        await asyncio.sleep(0.05)
+
+    gc.collect()
+    rss_before = _rss_mib()
+    if client_process:
+        report = await _run_client_process(argv)
+    else:
+        report = await client_from_args(args).run(args.rate, args.duration)
+    gc.collect()
+    rss_after = _rss_mib()
+
+    service.should_exit = True
+    await serving
+
+    print(f'target {args.rate:.0f} events/s for {args.duration:.0f}s, api latency {args.latency_ms:.1f} ms'
+          f'{" (client in subprocess)" if client_process else ""}')
+    print(f'sent        {report["sent"]} events, {report["events_per_sec"]:.0f} events/s')
+    print(f'received    {metrics.events_received.get(bot.name, "message"):.0f} message events by the bot')
+    print(f'commands    {report["commands"]} sent, {report["replies"]} replied, {report["unanswered"]} unanswered')
+    print(f'reply       p50 {report["p50_ms"]:.2f} ms, p99 {report["p99_ms"]:.2f} ms')
+    print(f'memory      rss {rss_before:.1f} -> {rss_after:.1f} MiB ({rss_after - rss_before:+.1f} MiB)')
+    print(f'executor    {bot.executor.stats()}')
+
+
+if __name__ == '__main__':
+    asyncio.run(main(sys.argv[1:]))
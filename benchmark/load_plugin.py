@@ -0,0 +1,13 @@
+# 压测使用的插件，命令与fake_client中EventMix的默认命令对应
+from extended_framework.command import on_command
+from extended_framework.lolibot.message import MessageEvent
+
+
+@on_command('ping')
+async def _(event: MessageEvent):
+    await event.send('pong')
+
+
+@on_command('echo')
+async def _(event: MessageEvent):
+    await event.send(event.message.get_plain_text())
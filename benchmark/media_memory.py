@@ -0,0 +1,92 @@
+# 媒体收发的峰值内存基准，比较原先一次性读取的方式与当前的流式方式
+# 每个场景在单独的子进程中运行，报告操作前后进程峰值RSS的增量（仅支持类unix系统）
+# 在仓库根目录下运行：python -m benchmark.media_memory [--size-mb 20]
+import argparse
+import asyncio
+import base64
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+from io import BytesIO
+
+SCENARIOS = ['encode_legacy', 'encode_stream', 'download_legacy', 'download_stream']
+
+
+def _peak_rss_mib() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10  # macOS单位为字节，linux为KiB
+
+
+def _legacy_encode(path: str) -> str:  # 原先Image的构造方式
+    with open(path, 'rb') as f:
+        data = f.read()
+    return 'base64://' + base64.b64encode(data).decode('utf-8')
+
+
+async def _download(scenario: str, path: str) -> None:
+    from aiohttp import web
+    from extended_framework.lolibot.util import get_image
+
+    app = web.Application()
+    app.router.add_get('/image', lambda request: web.FileResponse(path))
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    url = f'http://127.0.0.1:{port}/image'
+
+    try:
+        before = _peak_rss_mib()
+        if scenario == 'download_legacy':
+            result = BytesIO(await get_image.get_image(url, use_cache=False))
+        else:
+            result = await get_image.download_image(url, max_size=2 ** 31)
+        after = _peak_rss_mib()
+        result.close()
+        print(f'{after - before:.1f}')
+    finally:
+        await get_image.client.close()
+        await runner.cleanup()
+
+
+def _run_scenario(scenario: str, path: str) -> None:
+    if scenario.startswith('download'):
+        asyncio.run(_download(scenario, path))
+        return
+
+    from extended_framework.lolibot.message import Image
+    before = _peak_rss_mib()
+    result = _legacy_encode(path) if scenario == 'encode_legacy' else Image(path)
+    after = _peak_rss_mib()
+    del result
+    print(f'{after - before:.1f}')
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size-mb', type=int, default=20)
+    parser.add_argument('--scenario', choices=SCENARIOS)
+    parser.add_argument('--file')
+    args = parser.parse_args()
+
+    if args.scenario:
+        _run_scenario(args.scenario, args.file)
+        return
+
+    with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as f:
+        f.write(os.urandom(args.size_mb * 2 ** 20))
+    try:
+        print(f'peak RSS growth for a {args.size_mb} MiB image (base64 output alone is {args.size_mb * 4 / 3:.1f} MiB)')
+        for scenario in SCENARIOS:
+            out = subprocess.run([sys.executable, '-m', 'benchmark.media_memory', '--scenario', scenario,
+                                  '--file', f.name], capture_output=True, text=True, check=True).stdout
+            print(f'{scenario:<16} {out.strip().splitlines()[-1]:>7} MiB')
+    finally:
+        os.remove(f.name)
+
+
+if __name__ == '__main__':
+    main()
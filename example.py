@@ -5,7 +5,12 @@ if __name__ == '__main__':
     server = Server()
 
     main = Bot('main', '/').load_plugins_from_folder('example_plugins')
+    # 插件较多时可以根据命令清单延迟加载插件，见extended_framework/manifest.py
+    # main = load_plugins_lazily_from_folder(Bot('main', '/'), 'example_plugins')
     main.handle_msg_funcs.append(handle_msg())
 
+    # 开发时可以监视插件目录，修改插件后自动重载而不需要重启服务，见extended_framework/reload.py
+    # watch_plugins(server, main, 'example_plugins')
+
     # 可以根据需要在一个server对象上挂多个bot
     server.add_bot(main).run()
@@ -1,17 +1,28 @@
 from .lolibot.message import *
+from .lolibot.util.send_scheduler import Priority, SendDropped
 from .lolibot import Bot, current_bot, print_log  # , on_wsr_connection, on_message
+from .lolibot import metrics, offload
+from .lolibot.offload import EventData, OffloadTimeout
 # 使用current_bot以适配多个bot的命令隔离
 
 import asyncio
+import importlib
+import importlib.util
+import logging
 import random
+import sys
+import time
 import traceback
+import weakref
 
-from typing import Container, Dict, List, Callable, Awaitable
+from typing import Container, Dict, Iterable, List, Callable, Awaitable
 
 
-# 这一部分需要修改
+# 权限可以用 & | ~ 组合，组合时会展开嵌套并把开销小的集合查找排在前面，同一字段的固定白名单会合并为一个frozenset
+# Permission()表示允许所有人，Permission(*funcs)表示任意一个检查函数通过即可
 class Permission:
-    # 是否统一格式为from_funcs，同时禁止直接使用类名构造而只能通过方法构造，拆分为两个类
+    cost = 10  # 用于组合时排序，检查函数的开销未知，排在集合查找之后
+
     def __init__(self, *check_perm_funcs: Callable[[MessageEvent], bool]):
         self.check_perm_funcs = check_perm_funcs
 
@@ -20,34 +31,239 @@ class Permission:
             return True
         return any(func(event) for func in self.check_perm_funcs)
 
-    # 下面提供了两个基于白名单的权限检查对象
+    def __and__(self, other: 'Permission') -> 'Permission':
+        return _all_of(self, other)
+
+    def __or__(self, other: 'Permission') -> 'Permission':
+        return _any_of(self, other)
+
+    def __invert__(self) -> 'Permission':
+        return self.inner if isinstance(self, _NotPermission) else _NotPermission(self)
+
+    # 按(user_id, group_id)缓存检查结果，要求结果只取决于发送者和所在的群
+    # 其中的LiveIdSet发生变化时缓存会被清空，但普通的set等容器的变化无法被察觉，不应该与缓存一起使用
+    def cached(self, maxsize: int = 4096) -> 'Permission':
+        return _CachedPermission(self, maxsize)
+
+    def _children(self) -> tuple['Permission', ...]:
+        return ()
+
+    def _allows_all(self) -> bool:
+        return type(self) is Permission and not self.check_perm_funcs
+
+    # 下面提供了几个基于白名单的权限检查对象，传入LiveIdSet时可以在运行中修改名单
 
     @staticmethod
     def allow_user(*user_ids: int) -> 'Permission':
-        def checker(event: MessageEvent):
-            return event.sender.user_id in user_ids
-
-        return Permission(checker)
+        return _IdPermission('user_id', frozenset(user_ids))
 
     @staticmethod
     def allow_group(*group_ids: int) -> 'Permission':
-        def checker(event: MessageEvent):
-            return event.sender.group_id in group_ids
+        return _IdPermission('group_id', frozenset(group_ids))
 
-        return Permission(checker)
+    @staticmethod
+    def user_in(user_ids: 'Container[int] | LiveIdSet') -> 'Permission':
+        return _IdPermission('user_id', user_ids)
+
+    @staticmethod
+    def group_in(group_ids: 'Container[int] | LiveIdSet') -> 'Permission':
+        return _IdPermission('group_id', group_ids)
 
     @staticmethod
     def simple_allow_list(*, user_ids: Container[int] = ...,
                           group_ids: Container[int] = ...,
                           reverse: bool = False) -> 'Permission':
-        user_ids = user_ids if user_ids is not ... else set()
-        group_ids = group_ids if group_ids is not ... else set()
+        user_ids = user_ids if user_ids is not ... else frozenset()
+        group_ids = group_ids if group_ids is not ... else frozenset()
+
+        perm = Permission.user_in(user_ids) | Permission.group_in(group_ids)
+        return ~perm if reverse else perm
+
+
+# 可以在运行中修改的id集合，用于封禁名单等，修改时会清空引用了它的权限缓存
+class LiveIdSet:
+    def __init__(self, ids: Iterable[int] = ()):
+        self._ids = set(ids)
+        self._caches: weakref.WeakSet['_CachedPermission'] = weakref.WeakSet()
+
+    def __contains__(self, item) -> bool:
+        return item in self._ids
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __repr__(self):
+        return f'LiveIdSet({self._ids})'
+
+    def _changed(self) -> None:
+        for cache in self._caches:
+            cache.clear()
+
+    def add(self, item: int) -> None:
+        self._ids.add(item)
+        self._changed()
+
+    def discard(self, item: int) -> None:
+        self._ids.discard(item)
+        self._changed()
+
+    def update(self, items: Iterable[int]) -> None:
+        self._ids.update(items)
+        self._changed()
+
+    def clear(self) -> None:
+        self._ids.clear()
+        self._changed()
+
+
+class _IdPermission(Permission):
+    def __init__(self, attr: str, ids: 'Container[int] | LiveIdSet'):
+        super().__init__()
+        self.attr = attr  # 检查的sender字段，私聊时group_id为None
+        self.ids = ids
+        self.cost = 1 if isinstance(ids, (frozenset, set, LiveIdSet)) else 2
+
+    def check(self, event: MessageEvent) -> bool:
+        return getattr(event.sender, self.attr) in self.ids
+
+
+class _NotPermission(Permission):
+    def __init__(self, inner: Permission):
+        super().__init__()
+        self.inner = inner
+        self.cost = inner.cost
+
+    def check(self, event: MessageEvent) -> bool:
+        return not self.inner.check(event)
+
+    def _children(self) -> tuple[Permission, ...]:
+        return self.inner,
+
+
+class _AllOf(Permission):
+    def __init__(self, parts: List[Permission]):
+        super().__init__()
+        self.parts = tuple(sorted(parts, key=lambda perm: perm.cost))  # 开销小的先检查，不通过时直接短路
+        self.cost = sum(perm.cost for perm in parts)
+
+    def check(self, event: MessageEvent) -> bool:
+        for perm in self.parts:
+            if not perm.check(event):
+                return False
+        return True
+
+    def _children(self) -> tuple[Permission, ...]:
+        return self.parts
+
+
+class _AnyOf(_AllOf):
+    def check(self, event: MessageEvent) -> bool:
+        for perm in self.parts:
+            if perm.check(event):
+                return True
+        return False
+
 
-        def checker(event: MessageEvent) -> bool:
-            is_in = event.sender.user_id in user_ids or event.sender.group_id in group_ids
-            return not is_in if reverse else is_in
+def _all_of(*perms: Permission) -> Permission:
+    parts = []
+    for perm in perms:
+        if perm._allows_all():
+            continue
+        parts.extend(perm.parts if type(perm) is _AllOf else [perm])
+    if not parts:
+        return Permission()
+    return parts[0] if len(parts) == 1 else _AllOf(parts)
+
+
+def _any_of(*perms: Permission) -> Permission:
+    parts = []
+    frozen: Dict[str, frozenset] = {}  # 同一字段的固定名单合并为一次查找
+    for perm in perms:
+        if perm._allows_all():
+            return Permission()
+        for part in (perm.parts if type(perm) is _AnyOf else [perm]):
+            if isinstance(part, _IdPermission) and isinstance(part.ids, frozenset):
+                frozen[part.attr] = frozen.get(part.attr, frozenset()) | part.ids
+            else:
+                parts.append(part)
+    parts.extend(_IdPermission(attr, ids) for attr, ids in frozen.items())
+    return parts[0] if len(parts) == 1 else _AnyOf(parts)
+
+
+class _CachedPermission(Permission):
+    def __init__(self, inner: Permission, maxsize: int):
+        super().__init__()
+        self.inner = inner
+        self.maxsize = maxsize
+        self.cost = 1
+        self._cache: Dict[tuple[int, int | None], bool] = {}
+
+        # 统计数据
+        self.hits = 0
+        self.misses = 0
+
+        stack = [inner]
+        while stack:
+            perm = stack.pop()
+            if isinstance(perm, _IdPermission) and isinstance(perm.ids, LiveIdSet):
+                perm.ids._caches.add(self)
+            stack.extend(perm._children())
 
-        return Permission(checker)
+    def check(self, event: MessageEvent) -> bool:
+        key = (event.sender.user_id, event.sender.group_id)
+        if (res := self._cache.get(key)) is not None:
+            self.hits += 1
+            return res
+        self.misses += 1
+        if len(self._cache) >= self.maxsize:
+            del self._cache[next(iter(self._cache))]  # 按插入顺序淘汰最早的一项
+        res = self._cache[key] = self.inner.check(event)
+        return res
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def _children(self) -> tuple[Permission, ...]:
+        return self.inner,
+
+
+# 把权限转换为可以写入插件清单的dict，包含检查函数或者LiveIdSet等运行中才能确定的内容时返回None
+def _dump_permission(perm: Permission) -> dict | None:
+    if perm._allows_all():
+        return {'type': 'all'}
+    if isinstance(perm, _IdPermission):
+        if not isinstance(perm.ids, frozenset):  # set可能在运行中被修改，写入清单后修改不会生效
+            return None
+        return {'type': 'ids', 'attr': perm.attr, 'ids': sorted(perm.ids)}
+    if isinstance(perm, _NotPermission):
+        inner = _dump_permission(perm.inner)
+        return None if inner is None else {'type': 'not', 'inner': inner}
+    if isinstance(perm, _CachedPermission):
+        inner = _dump_permission(perm.inner)
+        return None if inner is None else {'type': 'cached', 'maxsize': perm.maxsize, 'inner': inner}
+    if type(perm) in (_AllOf, _AnyOf):
+        parts = [_dump_permission(part) for part in perm.parts]
+        if any(part is None for part in parts):
+            return None
+        return {'type': 'all_of' if type(perm) is _AllOf else 'any_of', 'parts': parts}
+    return None
+
+
+def _load_permission(data: dict) -> Permission:
+    kind = data['type']
+    if kind == 'all':
+        return Permission()
+    if kind == 'ids':
+        return _IdPermission(data['attr'], frozenset(data['ids']))
+    if kind == 'not':
+        return ~_load_permission(data['inner'])
+    if kind == 'cached':
+        return _load_permission(data['inner']).cached(data['maxsize'])
+    parts = [_load_permission(part) for part in data['parts']]
+    return _all_of(*parts) if kind == 'all_of' else _any_of(*parts)
 
 
 # 由于多个bot存在时使用装饰器会导致只有一个bot导入这个，所以暂时采用手动添加消息处理函数的方案
@@ -103,18 +319,16 @@ async def talk(event: MessageEvent):
 async def repeat(event: MessageEvent):
     # 需要考虑安全性
     if res := event.message.get_plain_text():
-        await event.send(res, reply=False, at_sender=False)
+        try:
+            # 复读的优先级最低，发送繁忙时会被直接丢弃
+            await event.send(res, reply=False, at_sender=False, priority=Priority.LOW)
+        except SendDropped:
+            pass
 
 
 def to_me(event: MessageEvent) -> bool:
     # 私聊默认True，群聊at机器人账号为True
-    if not (flag := not event.sender.group_id):
-        at_list = event.message.get_at_qq()
-        for item in at_list:
-            if item == event.self_id:
-                flag = True
-                break
-    return flag
+    return not event.sender.group_id or event.message.is_at(event.self_id)
 
 
 cmd_handler = Callable[[MessageEvent], Awaitable[None]]
@@ -129,13 +343,15 @@ class Hint(Exception):
 class Command:
     def __init__(self, main_name: str, func: cmd_handler, cmd_names: List[str], permission: Permission):
         self.name = main_name
-        self.func = Command.func_wrapper(func)
+        self.func = Command.func_wrapper(func, main_name)
         self.cmd = cmd_names
         self.permission = permission
+        self.module = func.__module__  # 注册该命令的插件模块，用于插件的延迟加载与重载
 
     @staticmethod
-    def func_wrapper(func: Callable[[MessageEvent], Awaitable[None]]):
+    def func_wrapper(func: Callable[[MessageEvent], Awaitable[None]], main_name: str = ''):
         async def wrapper(event: MessageEvent):
+            start = time.perf_counter()
             try:
                 await func(event)
             except Hint as e:
@@ -143,8 +359,11 @@ class Command:
             except SystemExit:
                 raise
             except:
-                print_log(traceback.format_exc())
+                metrics.handler_errors.inc(main_name)
+                print_log(traceback.format_exc(), logging.ERROR)
                 await event.send('发生了预料之外的错误，请联系bot管理员.')
+            finally:
+                metrics.handler_duration.observe(time.perf_counter() - start, main_name)
 
         return wrapper
 
@@ -153,44 +372,140 @@ class Command:
 
     def execute(self, event: MessageEvent):
         # 可以定义一个集成命令处理器来规范化输出以及错误处理等流程
-        asyncio.create_task(self.func(event))
+        current_bot.get().executor.submit(event.position, self.func, event)
+
 
+# 前缀树，每个bot的全部命令别名编译到一棵树上，匹配开销只与消息文本长度有关，与别名数量无关
+class _AliasTrie:
+    __slots__ = ('children', 'main_name')
 
-# 下面是自定义的指令注册与解析方式，使用了两层映射，增加了灵活性，但要注意性能问题
+    def __init__(self):
+        self.children: Dict[str, '_AliasTrie'] = {}
+        self.main_name: str | None = None  # 不为None时表示有别名在此节点结束
+
+    def insert(self, alias: str, main_name: str) -> None:
+        node = self
+        for char in alias:
+            node = node.children.setdefault(char, _AliasTrie())
+        node.main_name = main_name
+
+    def remove(self, alias: str) -> None:
+        path = [self]
+        for char in alias:
+            if (node := path[-1].children.get(char)) is None:
+                return
+            path.append(node)
+        path[-1].main_name = None
+        # 自底向上清理不再使用的节点
+        for char, parent, node in zip(reversed(alias), reversed(path[:-1]), reversed(path[1:])):
+            if node.children or node.main_name is not None:
+                break
+            del parent.children[char]
+
+    def conflict(self, alias: str) -> str | None:
+        # 返回与alias互为前缀的任意一个已有别名，不存在则返回None
+        node, walked = self, 0
+        for char in alias:
+            if node.main_name is not None:
+                return alias[:walked]
+            if (node := node.children.get(char)) is None:
+                return None
+            walked += 1
+        if node.main_name is not None:
+            return alias
+        # alias是已有别名的前缀，沿任意分支走到一个别名结尾
+        suffix = ''
+        while node.main_name is None:
+            char, node = next(iter(node.children.items()))
+            suffix += char
+        return alias + suffix
+
+    def match(self, text: str) -> List[tuple[str, str]]:
+        # 返回text开头匹配到的全部(别名, 命令名)，按别名长度从长到短排列
+        res = []
+        node = self
+        for i, char in enumerate(text):
+            if (node := node.children.get(char)) is None:
+                break
+            if node.main_name is not None:
+                res.append((text[:i + 1], node.main_name))
+        res.reverse()
+        return res
+
+
+# 下面是自定义的指令注册与解析方式，使用了两层映射，增加了灵活性
 # 建立别名到唯一标识的映射
 bot_to_alias: Dict['Bot', Dict[str, str]] = {}  # 建立机器人到其命令-别名映射的映射的字典
+# 与上面的映射保持同步，用于消息解析时的快速匹配
+bot_to_alias_trie: Dict['Bot', _AliasTrie] = {}
 # 建立唯一标识到命令对象的映射，存储函数的引用
 main_name_to_command: Dict[str, Command] = {}
 
+# 是否允许别名之间以对方开头，允许时解析为最长的匹配项（如 "查询" 与 "查询天气"）
+allow_nested_alias: bool = False
 
-# 装饰器，提供命令的注册与缓存
-def on_command(main_name: str, cmd_names: List[str] | None = None, *, permission: Permission = Permission()):
-    if cmd_names is None:
-        cmd_names = [main_name]
-    else:
-        cmd_names.append(main_name)
 
-    bot = current_bot.get()
+# 将命令对象注册到bot的各个映射中，命令名或者别名冲突时抛出异常且不会留下任何残留
+def _register_command(bot: 'Bot', command: 'Command | _LazyCommand') -> None:
+    main_name = command.name
     alias_to_main_name = bot_to_alias.setdefault(bot, {})
+    alias_trie = bot_to_alias_trie.setdefault(bot, _AliasTrie())
 
-    def deco(func: cmd_handler):
-        if main_name in main_name_to_command:
+    if (existing := main_name_to_command.get(main_name)) is not None:
+        if isinstance(existing, _LazyCommand) and isinstance(command, Command) and existing.module == command.module:
+            if existing.cmd == command.cmd:
+                # 延迟加载的插件被导入时，别名不变的命令只替换命令对象，不需要重建别名索引
+                main_name_to_command[main_name] = command
+                return
+            _unregister_command(bot, main_name)  # 插件的别名与清单不一致，按普通方式重新注册
+        else:
             raise Exception(f'命令 {main_name} 已经存在，无法重复注册.')
 
-        # 防止指令名称之间以对方开头，减小指令解析成本
-        # 如果需要修改可以建立互相包含的层级链路，解析为匹配的最后一项
-        for cmd in cmd_names:
-            for item in alias_to_main_name:
-                if item.startswith(cmd) or cmd.startswith(item):
-                    existing_main = alias_to_main_name[item]
-                    raise Exception(f'指令别名 {cmd}({main_name}) 与 {item}({existing_main}) 发生冲突，导入失败.')
+    for cmd in command.cmd:
+        if cmd in alias_to_main_name:
+            raise Exception(f'指令别名 {cmd}({main_name}) 与 {cmd}({alias_to_main_name[cmd]}) 发生冲突，导入失败.')
+        # 默认禁止指令名称之间以对方开头，开启allow_nested_alias后解析为匹配的最长一项
+        if not allow_nested_alias and (item := alias_trie.conflict(cmd)) is not None:
+            raise Exception(f'指令别名 {cmd}({main_name}) 与 {item}({alias_to_main_name[item]}) 发生冲突，导入失败.')
+
+    for cmd in command.cmd:
+        # 这里比较完之后再进行添加，防止同一指令的几个别名互相冲突或者导入失败后一部分别名残留
+        alias_to_main_name[cmd] = main_name
+        alias_trie.insert(cmd, main_name)
+
+    # 存储命令对象，可以配合permission等模块实现动态修改
+    main_name_to_command[main_name] = command
+
+
+def _unregister_command(bot: 'Bot', main_name: str) -> None:
+    command = main_name_to_command.pop(main_name)
+    alias_to_main_name = bot_to_alias.get(bot, {})
+    alias_trie = bot_to_alias_trie.get(bot)
+    for cmd in command.cmd:
+        if alias_to_main_name.get(cmd) == main_name:
+            del alias_to_main_name[cmd]
+            alias_trie.remove(cmd)
+
 
-        for cmd in cmd_names:
-            # 这里比较完之后再进行添加，防止同一指令的几个别名互相冲突或者导入失败后一部分别名残留
-            alias_to_main_name[cmd] = main_name
+# 装饰器，提供命令的注册与缓存
+# 指定executor为'process'或'thread'时，处理函数应为同步函数，接收EventData并在对应的池中执行，返回值不为None时作为回复发送
+# 进程池中的处理函数所在的插件会在工作进程中重新导入，此时没有bot，on_command只登记处理函数
+def on_command(main_name: str, cmd_names: List[str] | None = None, *, permission: Permission = Permission(),
+               executor: str | None = None, timeout: float | None = ...):
+    if cmd_names is None:
+        cmd_names = [main_name]
+    else:
+        cmd_names.append(main_name)
 
-        # 创建并存储命令对象，可以配合permission等模块实现动态修改
-        main_name_to_command[main_name] = Command(main_name, func, cmd_names, permission)
+    bot = current_bot.get(None) if offload.in_worker() else current_bot.get()
+
+    def deco(func: cmd_handler | Callable[[EventData], str | Message | None]):
+        if executor is not None:
+            key = (func.__module__, f'command:{main_name}')
+            offload.register(key, func, executor)
+            func = _offloaded_handler(executor, key, func, timeout)
+        if bot is not None:
+            _register_command(bot, Command(main_name, func, cmd_names, permission))
 
         # 函数已经添加到列表，如果不需要在其他地方手动调用则不需要return func
         # 如果需要手动调用，要注意应当调用未被装饰的原始函数，否则可能会导致重复添加（？）
@@ -198,13 +513,114 @@ def on_command(main_name: str, cmd_names: List[str] | None = None, *, permission
     return deco
 
 
-# 需要自定义配置，另外是否需要多种开头
+def _offloaded_handler(executor: str, key: tuple[str, str], func: Callable, timeout: float | None) -> cmd_handler:
+    async def handler(event: MessageEvent):
+        try:
+            result = await offload.run_registered(executor, key, EventData(event), timeout=timeout)
+        except OffloadTimeout:
+            print_log(lambda: f'Command {key[1].removeprefix("command:")} in {key[0]} timed out in {executor} pool.', logging.WARNING)
+            raise Hint('处理超时，请稍后再试.')
+        if result is not None:
+            await event.send(result)
+
+    handler.__module__ = func.__module__  # 插件的延迟加载与重载按模块查找命令
+    return handler
+
+
+# 延迟加载的插件在被导入前，用这个对象占据其命令的位置，权限检查通过后才会导入插件并执行真正的命令
+# 读取和编译插件文件在后台线程中进行，执行模块代码和注册命令仍在事件循环中；导入失败时保留占位命令，下次触发时重新尝试
+class _LazyCommand:
+    def __init__(self, main_name: str, cmd_names: List[str], module: str, permission: Permission):
+        self.name = main_name
+        self.cmd = cmd_names
+        self.module = module
+        self.permission = permission
+
+    def permission_check(self, event: MessageEvent):
+        return self.permission.check(event)
+
+    def execute(self, event: MessageEvent):
+        current_bot.get().executor.submit(event.position, self._load_and_run, event)
+
+    async def _load_and_run(self, event: MessageEvent):
+        command = await _load_lazy_plugin(current_bot.get(), self.module, self.name)
+        if command is None:
+            await event.send('发生了预料之外的错误，请联系bot管理员.')
+        elif command.permission_check(event):
+            await command.func(event)
+
+
+_lazy_loads: Dict[str, asyncio.Future] = {}  # 正在导入的延迟加载插件，同一插件被同时触发时只导入一次
+
+
+async def _load_lazy_plugin(bot: 'Bot', module: str, main_name: str) -> Command | None:
+    if (task := _lazy_loads.get(module)) is None:
+        task = _lazy_loads[module] = asyncio.ensure_future(_import_lazy_plugin(bot, module))
+        task.add_done_callback(lambda _: _lazy_loads.pop(module, None))
+    await asyncio.shield(task)
+    loaded = main_name_to_command.get(main_name)
+    return loaded if isinstance(loaded, Command) else None
+
+
+# 相当于importlib.import_module，只把读取文件和编译放到线程中
+# 模块代码必须在事件循环所在的线程中执行：其中注册命令会修改全局的命令表，插件也可能在导入时使用事件循环或者contextvars
+async def _import_module(name: str):
+    if (module := sys.modules.get(name)) is not None:
+        return module
+    spec = importlib.util.find_spec(name)  # 会先导入父包
+    if spec is None or spec.loader is None or not hasattr(spec.loader, 'get_code'):
+        return importlib.import_module(name)
+    code = await asyncio.to_thread(spec.loader.get_code, name)
+    if (module := sys.modules.get(name)) is not None:  # 等待编译期间已经被其他地方导入
+        return module
+
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    try:
+        exec(code, module.__dict__)
+    except BaseException:
+        sys.modules.pop(name, None)
+        raise
+    module = sys.modules[name]  # 与标准导入一致，模块可以在执行时替换自己在sys.modules中的对象
+    parent, _, child = name.rpartition('.')
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+
+async def _import_lazy_plugin(bot: 'Bot', module: str) -> None:
+    placeholders = {name: item for name, item in main_name_to_command.items()
+                    if isinstance(item, _LazyCommand) and item.module == module}
+    start = time.perf_counter()
+    try:
+        await _import_module(module)
+    except (Exception, SystemExit):
+        print_log(f'Error while lazily loading plugin {module}, will retry on next use:\n{traceback.format_exc()}',
+                  logging.ERROR)
+        # 清理导入到一半时注册的命令，恢复占位命令
+        for name in [name for name, item in main_name_to_command.items()
+                     if isinstance(item, Command) and item.module == module]:
+            _unregister_command(bot, name)
+        for name, placeholder in placeholders.items():
+            if name not in main_name_to_command:
+                _register_command(bot, placeholder)
+        return
+
+    # 清单中有但插件没有再注册的命令
+    for name, placeholder in placeholders.items():
+        if main_name_to_command.get(name) is placeholder:
+            _unregister_command(bot, name)
+    print_log(f'Lazily loaded plugin {module} in {(time.perf_counter() - start) * 1000:.1f} ms.')
+
+
+# 需要自定义配置，可以有多种开头，存在互为前缀的开头时优先匹配较长的一项
 # 可能需要指令族，即一组指令有同样的开头
 command_start: List[str] = ['']
 
 if command_start:
     if '' in command_start:
         command_start.clear()
+    command_start.sort(key=len, reverse=True)
 
 
 def check_command_like(event: MessageEvent) -> bool:
@@ -225,19 +641,19 @@ def _handle_command(event: MessageEvent) -> bool:
     if not check_command_like(event):
         return False
 
-    # 检查命令是否存在
+    # 检查命令是否存在，匹配结果从长到短排列，权限检查不通过时回退到较短的别名
     text = event.message.get_plain_text()
     bot = current_bot.get()
-    alias_to_main_name = bot_to_alias.get(bot, {})
+    if (alias_trie := bot_to_alias_trie.get(bot)) is None:
+        return False
 
-    for alias, main_name in alias_to_main_name.items():
-        if text.startswith(alias):
-            command = main_name_to_command[main_name]
-            # print(f'\nCommand {cmd} triggered. Checking permission...')
-            if command.permission_check(event):
-                # print(f'\nPermission check pass.')
-                # 更新事件消息，去掉命令部分
-                event.message.text = text[len(alias):].lstrip()  # 去掉指令正文左边可能存在的空格
-                command.execute(event)
-                return True
+    for alias, main_name in alias_trie.match(text):
+        if (command := main_name_to_command.get(main_name)) is None:
+            continue
+        if command.permission_check(event):
+            # 更新事件消息，去掉命令部分
+            event.message.text = text[len(alias):].lstrip()  # 去掉指令正文左边可能存在的空格
+            metrics.commands_dispatched.inc(bot.name, main_name)
+            command.execute(event)
+            return True
     return False
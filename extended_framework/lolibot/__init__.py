@@ -1,17 +1,13 @@
 from quart import Quart, websocket
 import uvicorn
 
-try:
-    import ujson as json  # 速度比python原生json库更快，但不支持非标准格式
-except ImportError:
-    import json
-
-from typing import Dict, Self, List, Callable
+from typing import Awaitable, Dict, Self, List, Callable
 
 Payload = Dict[str, int | str | Self]
 
-from .message import MessageEvent, _Captured
-from .bot_context import current_bot, print_log
+from .message import MessageEvent, _ExpectRegistry
+from .bot_context import current_bot, current_connection, print_log
+from . import codec
 
 # 这两个装饰器由于在多个机器人共用同一处理逻辑时会导致潜在的问题，建议谨慎使用
 # 可以参考实现逻辑手动添加处理函数
@@ -30,44 +26,20 @@ from .bot_context import current_bot, print_log
 #     return func  # 这里的return并无必要，只是为了留出扩展性
 
 
-import importlib
-import os
-import traceback
-
-
-def _load_plugins_from_list(plugin_routes: list[tuple[str, str]]):
-    for module in plugin_routes:
-        module_name, module_route = module
-        try:
-            importlib.import_module(module_route)
-            print_log(f'Successfully loaded plugin {module_name}.')
-        except:
-            print_log(f'Error while loading plugin {module_name}:\n{traceback.format_exc()}')
-
-
-def find_modules(plugin_folder: str, prefix: str = ''):
-    to_import: list[tuple[str, str]] = []
-
-    for filename in os.listdir(plugin_folder):
-        file_path = os.path.join(plugin_folder, filename)
-
-        # 将路径转换为模块名时，使用 os.path.sep 动态替换
-        normalized_folder = plugin_folder.replace(os.path.sep, '.')
+from .plugin import find_modules, load_plugins, PluginLoadReport
 
-        # 检查是否是Python文件
-        if filename.endswith('.py') and filename != '__init__.py':
-            filename = filename[:-3]
-            to_import.append((f'{prefix}{filename}', f'{normalized_folder}.{filename}'))
 
-        # 检查是否是包
-        elif os.path.isdir(file_path):
-            to_import.extend(find_modules(file_path, f'{prefix}{filename}.'))
-
-    return to_import
-
-
-from .util import _ResultStore
-import asyncio
+from .util import _ApiMultiplexer
+from .util.send_scheduler import SendScheduler
+from .util.message_cache import RecentMessageCache
+from .util.api_timeout import AdaptiveTimeouts
+from .util.outbox import Outbox
+from .executor import HandlerExecutor
+from .frame_filter import FrameFilter
+from .media import MediaStore
+from . import offload
+from . import metrics
+from .http_client import client as http_client
 
 
 # bot类，此类应当实现bot的配置以及命令处理逻辑，并通过将bot绑定到server的端点来激活命令处理，以实现在不同的端点提供不同的插件
@@ -79,16 +51,58 @@ class Bot:
         self.endpoint = endpoint
         self.handle_wsr_connection_funcs: List[Callable[[], None]] = []
         self.handle_msg_funcs: List[Callable[[MessageEvent], None]] = []
-
-    def load_plugins_from_list(self, plugin_routes: list[tuple[str, str]]):
+        self.handle_notice_funcs: List[Callable[[Payload], Awaitable[None]]] = []
+        self.handle_request_funcs: List[Callable[[Payload], Awaitable[None]]] = []
+        self.expect_registry = _ExpectRegistry()  # 按bot隔离，多个bot挂在同一个server上时不会互相抢走回复
+        self.max_api_in_flight = 64  # 每个连接同时等待响应的api调用数量上限，超出的调用排队等待
+        self.binary_frames = False  # 是否以二进制帧发送api调用，需要协议端支持，开启后可以省去编码为str的开销
+        self.connections: Dict[int, _ApiMultiplexer] = {}  # 当前连接的qq号 -> 该连接的api多路复用器，可以读取其中的统计数据
+        self.send_scheduler: SendScheduler | None = None  # 发送限流，默认不限流，设为SendScheduler()或自定义参数的对象即可开启
+        self.executor = HandlerExecutor()  # 处理函数的执行器，可以替换为自定义参数的对象
+        self.media_store: MediaStore | None = None  # 所属server启用媒体服务后由server设置
+        self.plugin_load_report: PluginLoadReport | None = None
+        # 最近收发的消息，get_msg会先在这里查找，设为None则不缓存
+        self.message_cache: RecentMessageCache | None = RecentMessageCache()
+        # 按action统计延迟并动态调整api超时时间，可以在overrides中按action配置上下限、重试和hedge，设为None则使用固定超时
+        self.api_timeouts: AdaptiveTimeouts | None = AdaptiveTimeouts()
+        # 连接断开时暂存发送消息的调用，重新连接后按顺序发送，默认不启用，可以设置为Outbox(path=...)以持久化到硬盘
+        self.outbox: Outbox | None = None
+        # 解码前丢弃不需要的事件，可以读取其中各类型被丢弃的数量，设为None则全部解码
+        self.frame_filter: FrameFilter | None = FrameFilter()
+
+    # 添加notice和request事件的处理函数，处理函数接收原始的payload，添加后对应的事件不再被frame_filter丢弃
+    # 返回传入的函数，可以作为装饰器使用
+    def add_notice_handler(self, func: Callable[[Payload], Awaitable[None]]):
+        self.handle_notice_funcs.append(func)
+        if self.frame_filter is not None:
+            self.frame_filter.subscribe('notice')
+        return func
+
+    def add_request_handler(self, func: Callable[[Payload], Awaitable[None]]):
+        self.handle_request_funcs.append(func)
+        if self.frame_filter is not None:
+            self.frame_filter.subscribe('request')
+        return func
+
+    # warm_imports为True时先并发导入插件依赖的第三方库，profile_memory为True时统计每个插件的内存变化
+    # 加载报告会输出到日志并保存在plugin_load_report中，指定report_path时另外保存为json
+    def load_plugins_from_list(self, plugin_routes: list[tuple[str, str]], *, warm_imports: bool = True,
+                               profile_memory: bool = False, report_path: str | None = None):
         bot_token = current_bot.set(self)
-        print_log('Waiting for plugins to be loaded...')
-        _load_plugins_from_list(plugin_routes)
-        current_bot.reset(bot_token)  # 注意如果上面抛出异常会导致问题
+        try:
+            print_log('Waiting for plugins to be loaded...')
+            report = load_plugins(plugin_routes, warm_imports=warm_imports, profile_memory=profile_memory)
+            print_log(lambda: f'Plugin load report:\n{report.table()}')
+        finally:
+            current_bot.reset(bot_token)
+
+        self.plugin_load_report = report
+        if report_path is not None:
+            report.save(report_path)
         return self
 
-    def load_plugins_from_folder(self, plugin_folder: str):
-        return self.load_plugins_from_list(find_modules(plugin_folder))
+    def load_plugins_from_folder(self, plugin_folder: str, **kwargs):
+        return self.load_plugins_from_list(find_modules(plugin_folder), **kwargs)
 
     # 当有客户端连接时quart框架会自动调用这个函数
     # 目前主流的客户端都是universal形式提供
@@ -97,38 +111,76 @@ class Bot:
         if role != 'universal':
             raise Exception('目前不支持universal客户端以外的连接形式.')
 
-        while True:
-            payload = json.loads(await websocket.receive())
+        self_id = int(websocket.headers.get('X-Self-ID', 0))
+        connection = _ApiMultiplexer(websocket._get_current_object(), self.max_api_in_flight, self_id,
+                                     binary=self.binary_frames)
+        self.connections[self_id] = connection
+        # 之后创建的消息处理task都会继承这个上下文，在其中调用api时会使用这个连接
+        connection_token = current_connection.set(connection)
 
-            if post_type := payload.get('post_type'):  # event推送，不会出现空字符串因此可以直接if
-                self._handle_event_func(payload, post_type)
-            else:  # api响应
-                _ResultStore.add(payload)
+        try:
+            while True:
+                frame = await websocket.receive()
+                if self.frame_filter is not None and self.frame_filter.drop(frame):
+                    continue
+                payload = codec.codec.loads(frame)  # 文本帧和二进制帧都可以直接解码
+
+                if post_type := payload.get('post_type'):  # event推送，不会出现空字符串因此可以直接if
+                    if not self_id and (self_id := payload.get('self_id', 0)):
+                        # 连接时没有X-Self-ID头，从第一个事件中得到账号，之后的api调用和消息缓存使用这个账号
+                        connection.self_id = self_id
+                        if self.connections.get(0) is connection:
+                            del self.connections[0]
+                        self.connections[self_id] = connection
+                    if post_type == 'message' and self.message_cache is not None:
+                        self.message_cache.put_frame(self_id, payload['message_id'], frame)
+                    self._handle_event_func(payload, post_type)
+                else:  # api响应
+                    connection.resolve(payload)
+        finally:
+            connection.close()
+            if self.connections.get(self_id) is connection:
+                del self.connections[self_id]
+            current_connection.reset(connection_token)
 
     def _handle_event_func(self, payload: Payload, post_type: str) -> None:
         bot_token = current_bot.set(self)
 
         # 如果需要在一个后端挂多个bot实现守护，可以在这里加上对心跳包的检测
+        metrics.events_received.inc(self.name, post_type)
 
-        if post_type == 'message':
-            try:
-                self._on_message(MessageEvent(payload))
-            except _Captured:
-                return
-        elif post_type == 'meta_event':
-            if payload.get('meta_event_type') == 'lifecycle' and payload.get('sub_type') == 'connect':
-                self._on_wsr_connection()
-
-        current_bot.reset(bot_token)  # 注意异常可能导致上下文恢复的缺失
+        try:
+            if post_type == 'message':
+                event = MessageEvent(payload)
+                if self.expect_registry.dispatch(event):
+                    print_log('Message Captured.')
+                else:
+                    self._on_message(event)
+            elif post_type == 'meta_event':
+                if payload.get('meta_event_type') == 'lifecycle' and payload.get('sub_type') == 'connect':
+                    self._on_wsr_connection()
+            elif post_type == 'notice':
+                self._on_payload(self.handle_notice_funcs, payload)
+            elif post_type == 'request':
+                self._on_payload(self.handle_request_funcs, payload)
+        finally:
+            current_bot.reset(bot_token)
 
     def _on_wsr_connection(self) -> None:
+        if self.outbox is not None:
+            self.outbox.drain(current_connection.get())
         for func in self.handle_wsr_connection_funcs:
-            asyncio.create_task(func())
+            self.executor.submit(None, func)
 
     # 注意如果有多个处理函数，需要避免修改event对象导致问题，如果出现问题可以考虑加锁或者传递拷贝
     def _on_message(self, event: MessageEvent) -> None:
         for func in self.handle_msg_funcs:
-            asyncio.create_task(func(event))
+            self.executor.submit(event.position, func, event)
+
+    def _on_payload(self, funcs: List[Callable[[Payload], None]], payload: Payload) -> None:
+        key = payload.get('group_id') or payload.get('user_id')
+        for func in funcs:
+            self.executor.submit(key, func, payload)
 
 
 # server类，封装了quart应用提供基于反向ws连接的消息收发功能，创建该类的实例并调用run方法以使用uvicorn启动服务
@@ -136,13 +188,116 @@ class Bot:
 class Server:
     def __init__(self, *, import_name: str = __name__, **server_app_kwargs):
         self._server_app = Quart(import_name, **server_app_kwargs)
+        self._bots: List[Bot] = []
+        self._address = ('127.0.0.1', 8082)
+        self._media_store: MediaStore | None = None
+        self._metrics: metrics.MetricsRegistry | None = None  # 各bot统计数据的指标，只属于这个server
+        self._metrics_routes: set[str] = set()
+        self._server_app.before_serving(self._startup)
+        self._server_app.after_serving(self._shutdown)
+
+    async def _startup(self) -> None:
+        await http_client.start()
+        if self._media_store is not None:
+            self._media_store.start(*self._address)
+        await offload.start()
+
+    async def _shutdown(self) -> None:
+        # 服务停止时等待各bot正在执行的处理函数结束
+        for bot in self._bots:
+            await bot.executor.shutdown()
+            if bot.outbox is not None:
+                bot.outbox.close()
+        if self._media_store is not None:
+            self._media_store.close()
+        offload.shutdown()
+        await http_client.close()
+
+    # 注册在服务启动后、停止前调用的函数，可以用来启动和停止后台任务
+    def on_startup(self, func: Callable[[], Awaitable[None]]):
+        self._server_app.before_serving(func)
+        return self
+
+    def on_shutdown(self, func: Callable[[], Awaitable[None]]):
+        self._server_app.after_serving(func)
+        return self
+
+    # 修改全局http客户端的连接池、超时和重试配置，配置项见http_client.HttpClient
+    def configure_http(self, **config):
+        http_client.configure(**config)
+        return self
 
     def run(self, host: str = '127.0.0.1', port: int = 8082, *args, **kwargs) -> None:
         if 'log_config' not in kwargs:
             kwargs['log_config'] = None
+        self._address = (host, port)
         print(f'Starting service on {host}:{port}...\n')
         uvicorn.run(self._server_app, host=host, port=port, *args, **kwargs)
 
     def add_bot(self, bot: Bot):
         self._server_app.add_websocket(bot.endpoint, view_func=bot._handle_wsr_conn, endpoint=f'{bot.endpoint}_ws')
+        self._bots.append(bot)
+        bot.media_store = self._media_store
         return self
+
+    # 启用后Image默认通过http链接发送，而不是把base64内联到ws消息中
+    # base_url为协议端访问这个server的地址，不指定时使用run的监听地址，协议端与bot不在同一台机器上时需要指定
+    # 链接在超过ttl秒后失效，指定max_deliveries时被完整获取max_deliveries次后也会失效
+    def enable_media_hosting(self, base_url: str | None = None, *, route: str = '/media', ttl: float = 300,
+                             max_deliveries: int | None = None):
+        if self._media_store is not None:
+            raise Exception('媒体服务已经启用.')
+        store = MediaStore(base_url, route=route, ttl=ttl, max_deliveries=max_deliveries)
+        self._server_app.add_url_rule(f'{route}/<token>', endpoint='media', view_func=store.serve)
+        self._media_store = store
+        for bot in self._bots:
+            bot.media_store = store
+        return self
+
+    # 在route上以prometheus文本格式导出metrics.registry中的指标，以及这个server上各bot的队列深度等统计数据
+    # 各bot的统计数据注册在server自己的registry中，多个server互不影响，重复调用只会增加新的route
+    def enable_metrics(self, route: str = '/metrics'):
+        if self._metrics is None:
+            self._metrics = self._bot_metrics()
+        if route not in self._metrics_routes:
+            registry = self._metrics
+
+            async def export():
+                return (metrics.registry.render() + registry.render(), 200,
+                        {'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+            self._server_app.add_url_rule(route, endpoint=f'metrics{route}', view_func=export)
+            self._metrics_routes.add(route)
+        return self
+
+    def _bot_metrics(self) -> metrics.MetricsRegistry:
+        registry = metrics.MetricsRegistry()
+        bots = self._bots
+
+        registry.gauge('lolibot_executor_running', 'Handlers running in the executor.', ('bot',),
+                       lambda: [((bot.name,), bot.executor.running) for bot in bots])
+        registry.gauge('lolibot_executor_parked', 'Handlers waiting for a reply in expect().', ('bot',),
+                       lambda: [((bot.name,), bot.executor.parked) for bot in bots])
+        registry.gauge('lolibot_executor_queued', 'Handlers waiting in the executor queue.', ('bot',),
+                       lambda: [((bot.name,), bot.executor.queued) for bot in bots])
+        registry.counter('lolibot_executor_dropped_total', 'Handlers dropped because the queue was full.', ('bot',),
+                         lambda: [((bot.name,), bot.executor.dropped) for bot in bots])
+        registry.counter('lolibot_executor_timeouts_total', 'Handlers cancelled by the executor timeout.', ('bot',),
+                         lambda: [((bot.name,), bot.executor.timeouts) for bot in bots])
+        registry.gauge('lolibot_send_queue_depth', 'Messages waiting in the send scheduler.', ('bot',),
+                       lambda: [((bot.name,), bot.send_scheduler.depth) for bot in bots
+                                if bot.send_scheduler is not None])
+        registry.counter('lolibot_send_dropped_total', 'Messages dropped by the send scheduler.', ('bot',),
+                         lambda: [((bot.name,), bot.send_scheduler.dropped) for bot in bots
+                                  if bot.send_scheduler is not None])
+        registry.gauge('lolibot_api_in_flight', 'Api calls waiting for a response.', ('bot', 'self_id'),
+                       lambda: [((bot.name, self_id), connection.outstanding)
+                                for bot in bots for self_id, connection in bot.connections.items()])
+        registry.gauge('lolibot_api_queued', 'Api calls waiting for an in-flight slot.', ('bot', 'self_id'),
+                       lambda: [((bot.name, self_id), connection.queued)
+                                for bot in bots for self_id, connection in bot.connections.items()])
+        registry.counter('lolibot_frames_dropped_total', 'Frames dropped by the frame filter before decoding.',
+                         ('bot', 'type'),
+                         lambda: [((bot.name, kind), count) for bot in bots if bot.frame_filter is not None
+                                  for kind, count in bot.frame_filter.dropped.items()])
+        return registry
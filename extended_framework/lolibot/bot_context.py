@@ -2,12 +2,8 @@ from contextvars import ContextVar
 
 # 定义 `ContextVar`，用于存储当前 bot 实例
 current_bot: ContextVar['Bot'] = ContextVar('current_bot')
+# 当前处理的反向ws连接对应的api多路复用器，由bot在收到连接时设置
+current_connection: ContextVar['_ApiMultiplexer'] = ContextVar('current_connection')
 
-from datetime import datetime
-
-
-def print_log(content: str):
-    now = datetime.now()
-    datetime_str = now.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
-    bot = current_bot.get()
-    print(f'[{datetime_str}] {bot.name}:\n{content}\n')
+# 日志的实现见logger模块，这里保留原先的导入位置
+from .logger import print_log
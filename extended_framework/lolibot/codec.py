@@ -0,0 +1,136 @@
+# ws消息的json编解码，按orjson、msgspec、ujson、标准库json的顺序选择已安装的实现
+# 接收时直接解码bytes或str，发送时orjson和msgspec直接编码为bytes，不经过中间的str
+# 内联的大段base64以AsciiBuffer的形式放在消息中，编码时直接拼接到结果里，不需要先复制为一份同样大小的str
+import json
+import secrets
+
+from typing import Any, Callable, Dict, List
+
+
+class AsciiBuffer:
+    # data中只能包含不需要json转义的ascii字符（比如base64），编码时原样写在json字符串的引号之间
+    __slots__ = ('data',)
+
+    def __init__(self, data: bytes | bytearray):
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __str__(self):
+        return self.data.decode('ascii')
+
+
+# 编码时用来代替AsciiBuffer的占位字符串，私有区字符也可能出现在用户发送的文本中，所以每次编码都带上随机的nonce
+def _placeholder(nonce: str, index: int) -> str:
+    return f'\ue000{nonce}:{index}\ue000'
+
+
+class Codec:
+    def __init__(self, name: str, loads: Callable[[bytes | str], Any], dumps: Callable[[Any], bytes],
+                 dumps_text: Callable[[Any], str], dumps_hooked: Callable[[Any, Callable[[Any], Any]], bytes]):
+        self.name = name
+        self.loads = loads  # 同时接受bytes和str
+        self._dumps = dumps
+        self._dumps_text = dumps_text
+        self._dumps_hooked = dumps_hooked  # 带default钩子的编码，只在遇到AsciiBuffer时使用
+
+    def __repr__(self):
+        return f'Codec({self.name})'
+
+    # 编码为bytes，用于二进制帧
+    def dumps(self, obj: Any) -> bytes:
+        try:
+            return self._dumps(obj)
+        except TypeError:  # 各个实现遇到不支持的类型时都会抛出TypeError，正常的消息不会进入这里
+            return self._splice(obj)
+
+    # 编码为str，用于文本帧
+    def dumps_text(self, obj: Any) -> str:
+        try:
+            return self._dumps_text(obj)
+        except TypeError:
+            return self._splice(obj).decode()
+
+    def _splice(self, obj: Any) -> bytes:
+        buffers: List[bytes | bytearray] = []
+        nonce = secrets.token_hex(8)
+
+        def hook(value: Any) -> str:
+            if isinstance(value, AsciiBuffer):
+                buffers.append(value.data)
+                return _placeholder(nonce, len(buffers) - 1)
+            raise TypeError(f'Type is not JSON serializable: {type(value).__name__}')
+
+        rest = self._dumps_hooked(obj, hook)
+        parts = []
+        for i, data in enumerate(buffers):
+            before, rest = rest.split(_placeholder(nonce, i).encode(), 1)
+            parts += (before, data)
+        parts.append(rest)
+        return b''.join(parts)
+
+
+def _orjson() -> Codec:
+    import orjson
+    return Codec('orjson', orjson.loads, orjson.dumps, lambda obj: orjson.dumps(obj).decode(),
+                 lambda obj, hook: orjson.dumps(obj, default=hook))
+
+
+def _msgspec() -> Codec:
+    import msgspec
+    decoder = msgspec.json.Decoder()
+    encoder = msgspec.json.Encoder()
+    return Codec('msgspec', decoder.decode, encoder.encode, lambda obj: encoder.encode(obj).decode(),
+                 lambda obj, hook: msgspec.json.Encoder(enc_hook=hook).encode(obj))
+
+
+def _ujson() -> Codec:
+    import ujson  # 速度比python原生json库更快，但不支持非标准格式
+    return Codec('ujson', ujson.loads, lambda obj: ujson.dumps(obj, ensure_ascii=False).encode(),
+                 lambda obj: ujson.dumps(obj, ensure_ascii=False),
+                 lambda obj, hook: ujson.dumps(obj, ensure_ascii=False, default=hook).encode())
+
+
+def _json() -> Codec:
+    return Codec('json', json.loads, lambda obj: json.dumps(obj, ensure_ascii=False).encode(),
+                 lambda obj: json.dumps(obj, ensure_ascii=False),
+                 lambda obj, hook: json.dumps(obj, ensure_ascii=False, default=hook).encode())
+
+
+_factories: Dict[str, Callable[[], Codec]] = {
+    'orjson': _orjson,
+    'msgspec': _msgspec,
+    'ujson': _ujson,
+    'json': _json,
+}
+
+
+def available_codecs() -> Dict[str, Codec]:
+    res = {}
+    for name, factory in _factories.items():
+        try:
+            res[name] = factory()
+        except ImportError:
+            continue
+    return res
+
+
+def get_codec(name: str | None = None) -> Codec:
+    if name is not None:
+        return _factories[name]()
+    for factory in _factories.values():
+        try:
+            return factory()
+        except ImportError:
+            continue
+    raise ImportError  # 标准库json总是可用，不会到达这里
+
+
+# 当前使用的编解码实现，可以通过set_codec指定
+codec: Codec = get_codec()
+
+
+def set_codec(name: str) -> None:
+    global codec
+    codec = get_codec(name)
@@ -0,0 +1,147 @@
+# 消息处理函数的执行器，每个bot持有一个
+# 限制同时运行的处理函数数量，排队中的任务按对话位置分组轮流执行，避免单个刷屏的群占满处理能力
+# 队列过长时直接丢弃新任务，同时持有所有运行中task的强引用，防止被垃圾回收
+# 在expect中等待回复的处理函数不占用并发数，等待中的对话不会挡住新的命令
+import asyncio
+import contextlib
+import contextvars
+import logging
+import traceback
+
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Iterator, Set, Tuple
+
+from .bot_context import print_log
+
+_Job = Tuple[contextvars.Context, Callable[..., Awaitable[Any]], tuple, float | None]
+
+
+class HandlerExecutor:
+    # handler_timeout为单个处理函数的默认超时时间，为None时不限制（注意expect等待回复的时间也会计算在内）
+    def __init__(self, *, max_concurrency: int = 32, max_queued: int = 1000, max_queued_per_key: int = 100,
+                 handler_timeout: float | None = None):
+        self.max_concurrency = max_concurrency
+        self.max_queued = max_queued
+        self.max_queued_per_key = max_queued_per_key
+        self.handler_timeout = handler_timeout
+
+        self._queues: Dict[Hashable, Deque[_Job]] = {}
+        self._ring: Deque[Hashable] = deque()  # 有任务排队的key，按轮转顺序排列
+        self._queued = 0
+        self._tasks: Set[asyncio.Task] = set()
+        self._parked: Set[asyncio.Task] = set()  # 正在expect中等待回复的任务，不计入并发数
+        self._closing = False
+        self._idle: asyncio.Event | None = None
+
+        # 统计数据
+        self.submitted = 0
+        self.dropped = 0
+        self.timeouts = 0
+        self.failed = 0
+
+    @property
+    def running(self) -> int:
+        return len(self._tasks) - len(self._parked)
+
+    @property
+    def parked(self) -> int:
+        return len(self._parked)
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'running': self.running,
+            'parked': self.parked,
+            'queued': self.queued,
+            'submitted': self.submitted,
+            'dropped': self.dropped,
+            'timeouts': self.timeouts,
+            'failed': self.failed,
+        }
+
+    # 提交一个处理函数，key一般为事件的对话位置，同一个key下的任务按提交顺序执行
+    # 处理函数会在提交时的上下文中运行（保留current_bot等），返回是否成功加入队列
+    def submit(self, key: Hashable, func: Callable[..., Awaitable[Any]], *args,
+               timeout: float | None = ...) -> bool:
+        queue = self._queues.get(key)
+        if self._closing or self._queued >= self.max_queued or \
+                (queue is not None and len(queue) >= self.max_queued_per_key):
+            self.dropped += 1
+            return False
+
+        if queue is None:
+            queue = self._queues[key] = deque()
+            self._ring.append(key)
+        timeout = self.handler_timeout if timeout is ... else timeout
+        queue.append((contextvars.copy_context(), func, args, timeout))
+        self._queued += 1
+        self.submitted += 1
+        self._pump()
+        return True
+
+    def _pump(self) -> None:
+        while self._ring and self.running < self.max_concurrency:
+            key = self._ring.popleft()
+            queue = self._queues[key]
+            context, func, args, timeout = queue.popleft()
+            if queue:
+                self._ring.append(key)
+            else:
+                del self._queues[key]
+            self._queued -= 1
+
+            task = asyncio.create_task(self._run(func, args, timeout), context=context)
+            self._tasks.add(task)
+            task.add_done_callback(self._on_done)
+
+    # 在处理函数中使用，期间当前任务让出占用的并发数，结束等待后即使并发数已满也会直接继续执行，不会重新排队
+    @contextlib.contextmanager
+    def parking(self) -> Iterator[None]:
+        task = asyncio.current_task()
+        if task not in self._tasks or task in self._parked:
+            yield
+            return
+        self._parked.add(task)
+        self._pump()
+        try:
+            yield
+        finally:
+            self._parked.discard(task)
+
+    def _on_done(self, task: asyncio.Task) -> None:
+        self._tasks.discard(task)
+        self._parked.discard(task)
+        self._pump()
+        if self._idle is not None and not self._tasks and not self._queued:
+            self._idle.set()
+
+    async def _run(self, func: Callable[..., Awaitable[Any]], args: tuple, timeout: float | None) -> None:
+        try:
+            await asyncio.wait_for(func(*args), timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            print_log(f'Handler {getattr(func, "__qualname__", func)} timeout with timeout_sec {timeout}.',
+                      logging.WARNING)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.failed += 1
+            print_log(traceback.format_exc(), logging.ERROR)
+
+    # 停止接收新任务，等待排队中和运行中的任务完成，超时后取消剩余的任务
+    async def shutdown(self, timeout: float | None = 10) -> None:
+        self._closing = True
+        if self._tasks or self._queued:
+            self._idle = asyncio.Event()
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout)
+            except asyncio.TimeoutError:
+                self._queues.clear()
+                self._ring.clear()
+                self._queued = 0
+                for task in list(self._tasks):
+                    task.cancel()
+                await asyncio.gather(*self._tasks, return_exceptions=True)
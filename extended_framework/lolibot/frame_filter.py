@@ -0,0 +1,67 @@
+# 在完整解码前对收到的帧做粗略分类，直接丢弃不需要处理的事件（心跳、没有订阅的notice和request等）
+# 分类只用正则在帧开头的一段中查找post_type等字段，消息内容中的引号会被转义，不会误匹配
+# 需要丢弃的事件都很短，会被完整覆盖；较长的消息帧只检查开头，不会因为分类而多扫描一遍整个帧
+# 在检查范围内找不到字段或者无法确定类型的帧一律交给后续完整解码，api响应（带echo或retcode）永远不会被丢弃
+# 只采用顶层的post_type：响应的data中可能包含消息，协议端也可能把data写在status、retcode和echo之前，
+# 所以匹配位置之前只能有最外层的一个左花括号，否则当作无法确定（字符串中的花括号也会导致不丢弃，只是少过滤一些帧）
+import re
+
+from typing import Dict, Iterable
+
+_response = re.compile(r'"(?:echo|retcode)"\s*:')  # 响应的data中可能包含消息，其中也有post_type
+_post_type = re.compile(r'"post_type"\s*:\s*"(\w+)"')
+_meta_event_type = re.compile(r'"meta_event_type"\s*:\s*"(\w+)"')
+
+_response_bytes = re.compile(_response.pattern.encode())
+_post_type_bytes = re.compile(_post_type.pattern.encode())
+_meta_event_type_bytes = re.compile(_meta_event_type.pattern.encode())
+
+
+class FrameFilter:
+    # ignore中的类型为post_type，meta_event按'meta_event.<meta_event_type>'区分，prefix为检查的帧开头长度
+    def __init__(self, ignore: Iterable[str] = ('meta_event.heartbeat', 'notice', 'request', 'message_sent'), *,
+                 prefix: int = 512):
+        self.ignore = set(ignore)
+        self.prefix = prefix
+        self.subscribed: set[str] = set()  # 订阅的类型即使在ignore中也不会被丢弃
+
+        # 统计数据
+        self.passed = 0
+        self.dropped: Dict[str, int] = {}
+
+    def subscribe(self, kind: str) -> None:
+        self.subscribed.add(kind)
+
+    def unsubscribe(self, kind: str) -> None:
+        self.subscribed.discard(kind)
+
+    # 返回帧的类型，api响应或者无法确定时返回None
+    def classify(self, frame: str | bytes) -> str | None:
+        if isinstance(frame, str):
+            response, post_type, meta_event_type = _response, _post_type, _meta_event_type
+        else:
+            response, post_type, meta_event_type = _response_bytes, _post_type_bytes, _meta_event_type_bytes
+
+        end = self.prefix  # 传入endpos只检查开头，不需要先切片复制
+        brace = '{' if isinstance(frame, str) else b'{'
+        if response.search(frame, 0, end) or (match := post_type.search(frame, 0, end)) is None \
+                or frame.count(brace, 0, match.start()) != 1:
+            return None
+        kind = match.group(1)
+        if kind in ('meta_event', b'meta_event'):
+            if (match := meta_event_type.search(frame, 0, end)) is None or frame.count(brace, 0, match.start()) != 1:
+                return None
+            kind += (b'.' if isinstance(kind, bytes) else '.') + match.group(1)
+        return kind.decode() if isinstance(kind, bytes) else kind
+
+    # 返回是否丢弃这个帧
+    def drop(self, frame: str | bytes) -> bool:
+        kind = self.classify(frame)
+        if kind is None or kind not in self.ignore or kind in self.subscribed:
+            self.passed += 1
+            return False
+        self.dropped[kind] = self.dropped.get(kind, 0) + 1
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        return {'passed': self.passed, **{f'dropped.{kind}': count for kind, count in self.dropped.items()}}
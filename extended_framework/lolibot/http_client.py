@@ -0,0 +1,112 @@
+# 全局共用的http客户端，连接池在server启动时创建、停止时关闭，插件可以直接使用这里的client而不需要各自创建session
+# 建立连接失败、超时以及429和5xx响应会按带随机抖动的指数退避重试，默认只重试幂等的请求
+# 不经过server启动时（比如单独运行的脚本），第一次请求时才创建session，需要自行调用close
+import asyncio
+import contextlib
+import random
+
+from typing import AsyncIterator, Dict
+
+import aiohttp
+
+_retry_statuses = frozenset({429, 500, 502, 503, 504})
+_idempotent_methods = frozenset({'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'})
+
+
+class HttpClient:
+    def __init__(self, **config):
+        # 连接池
+        self.limit = 100  # 同时打开的连接总数上限
+        self.limit_per_host = 16  # 对同一个host同时打开的连接数上限
+        self.keepalive_timeout = 30.0  # 空闲连接保留的秒数
+        self.dns_cache_ttl = 300  # dns解析结果缓存的秒数
+        # 超时，单位为秒，为None时不限制
+        self.total_timeout: float | None = 60.0
+        self.connect_timeout: float | None = 10.0
+        self.read_timeout: float | None = 30.0  # 两次读取到数据之间的最长间隔
+        # 重试
+        self.retries = 2
+        self.backoff = 0.5  # 第n次重试前最多等待backoff * 2 ** (n - 1)秒
+        self.max_backoff = 8.0
+        self.trust_env = True  # 读取环境变量中的代理设置
+
+        self._session: aiohttp.ClientSession | None = None
+        self.configure(**config)
+
+        # 统计数据
+        self.requests = 0
+        self.retried = 0
+        self.failed = 0
+
+    # 修改上面的配置，需要在session创建之前调用
+    def configure(self, **config) -> None:
+        if self._session is not None:
+            raise Exception('http客户端已经启动，无法修改配置.')
+        for key, value in config.items():
+            if not hasattr(self, key) or key.startswith('_'):
+                raise Exception(f'未知的http客户端配置项 {key}.')
+            setattr(self, key, value)
+
+    def stats(self) -> Dict[str, int]:
+        return {'requests': self.requests, 'retried': self.retried, 'failed': self.failed}
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, limit_per_host=self.limit_per_host,
+                                             keepalive_timeout=self.keepalive_timeout,
+                                             use_dns_cache=True, ttl_dns_cache=self.dns_cache_ttl)
+            timeout = aiohttp.ClientTimeout(total=self.total_timeout, connect=self.connect_timeout,
+                                            sock_read=self.read_timeout)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout, trust_env=self.trust_env)
+        return self._session
+
+    async def start(self) -> None:
+        _ = self.session
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def _backoff(self, attempt: int) -> float:
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+    # 用法与session.request相同，在async with中使用，只有拿到响应之前的失败会重试，读取响应内容时的失败不会重试
+    # retries为None时幂等请求使用默认的重试次数，其他请求不重试
+    @contextlib.asynccontextmanager
+    async def request(self, method: str, url: str, *, retries: int | None = None,
+                      **kwargs) -> AsyncIterator[aiohttp.ClientResponse]:
+        if retries is None:
+            retries = self.retries if method.upper() in _idempotent_methods else 0
+
+        self.requests += 1
+        attempt = 0
+        while True:
+            try:
+                resp = await self.session.request(method, url, **kwargs)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt >= retries:
+                    self.failed += 1
+                    raise
+            else:
+                if resp.status not in _retry_statuses or attempt >= retries:
+                    break
+                resp.release()
+            attempt += 1
+            self.retried += 1
+            await asyncio.sleep(self._backoff(attempt))
+
+        try:
+            yield resp
+        finally:
+            resp.release()
+
+    def get(self, url: str, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+
+client = HttpClient()
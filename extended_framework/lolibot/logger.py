@@ -0,0 +1,166 @@
+# 日志模块，基于标准库logging实现
+# 调用方只负责把日志记录放入队列，格式化与输出都在后台线程中完成，避免在事件循环中同步写stdout阻塞消息处理
+# 每个bot使用独立的logger（lolibot.<bot名称>），可以按bot单独调整级别
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+from datetime import datetime
+from typing import Callable
+
+from .bot_context import current_bot
+
+ROOT_LOGGER_NAME = 'lolibot'
+
+_root_logger = logging.getLogger(ROOT_LOGGER_NAME)
+_root_logger.propagate = False
+_loggers: dict[str, logging.Logger] = {}
+
+_queue_handler: '_DeferredQueueHandler | None' = None
+_listener: '_DeferredQueueListener | None' = None
+_configured = False
+
+
+# 延迟格式化的日志内容，只有在后台线程真正输出时才会调用
+class _LazyContent:
+    __slots__ = ('func',)
+
+    def __init__(self, func: Callable[[], str]):
+        self.func = func
+
+    def __str__(self):
+        return self.func()
+
+
+# 标准库的QueueHandler会在入队前就完成格式化，这里改为原样入队，并在队列满时直接丢弃而不是阻塞
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# 队列有上限，停止时队列可能是满的，标准库用put_nowait放入结束标记会抛出queue.Full，后台线程也不会退出
+# 这里改为阻塞等待，后台线程仍在消费队列，很快就能放入
+class _DeferredQueueListener(logging.handlers.QueueListener):
+    def enqueue_sentinel(self) -> None:
+        self.queue.put(self._sentinel)
+
+
+# 对标记为hot的日志（每条收发消息的内容）按比例采样，为0时全部丢弃
+class _HotPathFilter(logging.Filter):
+    def __init__(self, sample_rate: float):
+        super().__init__()
+        self.sample_rate = sample_rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, 'hot', False) or self.sample_rate >= 1:
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+
+def _bot_name(record: logging.LogRecord) -> str:
+    return record.name[len(ROOT_LOGGER_NAME) + 1:] if record.name != ROOT_LOGGER_NAME else ROOT_LOGGER_NAME
+
+
+# 保持原先print_log的输出格式
+class _TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        datetime_str = datetime.fromtimestamp(record.created).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+        level = '' if record.levelno == logging.INFO else f' [{record.levelname}]'
+        content = record.getMessage()
+        if record.exc_info:
+            content = f'{content}\n{self.formatException(record.exc_info)}'
+        return f'[{datetime_str}] {_bot_name(record)}{level}:\n{content}\n'
+
+
+class _JsonLinesFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        item = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'bot': _bot_name(record),
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            item['exc'] = self.formatException(record.exc_info)
+        return json.dumps(item, ensure_ascii=False)
+
+
+# 配置日志输出，可以重复调用以修改配置；不调用时会在第一次输出日志时使用默认配置
+# hot_sample_rate控制每条收发消息内容的日志的采样比例，消息量很大时可以调低或者设为0
+def setup_logging(level: int = logging.INFO, *, console: bool = True,
+                  file: str | None = None, max_bytes: int = 10 * 2 ** 20, backup_count: int = 5,
+                  json_lines: bool = False, hot_sample_rate: float = 1.0, queue_size: int = 10000) -> None:
+    global _queue_handler, _listener, _configured
+    shutdown_logging()
+    _configured = True
+
+    formatter = _JsonLinesFormatter() if json_lines else _TextFormatter()
+    handlers = []
+    if console:
+        handlers.append(logging.StreamHandler(sys.stdout))
+    if file:
+        handlers.append(logging.handlers.RotatingFileHandler(file, maxBytes=max_bytes, backupCount=backup_count,
+                                                             encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    log_queue = queue.Queue(queue_size)
+    _queue_handler = _DeferredQueueHandler(log_queue)
+    _queue_handler.addFilter(_HotPathFilter(hot_sample_rate))
+    _root_logger.handlers = [_queue_handler]
+    _root_logger.setLevel(level)
+
+    _listener = _DeferredQueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+
+
+# 停止后台线程，会先输出队列中剩余的日志
+def shutdown_logging() -> None:
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.close()
+        _listener = None
+
+
+atexit.register(shutdown_logging)
+
+
+def logging_stats() -> dict[str, int]:
+    if _queue_handler is None:
+        return {'queued': 0, 'dropped': 0}
+    return {'queued': _queue_handler.queue.qsize(), 'dropped': _queue_handler.dropped}
+
+
+def get_logger(bot: 'Bot | None' = None) -> logging.Logger:
+    if bot is None:
+        bot = current_bot.get(None)
+    name = f'{ROOT_LOGGER_NAME}.{bot.name}' if bot is not None else ROOT_LOGGER_NAME
+    if (logger := _loggers.get(name)) is None:
+        logger = _loggers[name] = logging.getLogger(name)
+    return logger
+
+
+# content可以传入返回字符串的函数，只在日志真正输出时才调用，以避免热点路径上不必要的格式化
+# hot表示这是每条消息都会产生的日志，会受到采样比例的控制
+def print_log(content: str | Callable[[], str], level: int = logging.INFO, *, hot: bool = False) -> None:
+    if not _configured:
+        setup_logging()
+    logger = get_logger()
+    if not logger.isEnabledFor(level):
+        return
+    logger.log(level, _LazyContent(content) if callable(content) else content, extra={'hot': hot})
@@ -0,0 +1,179 @@
+# 通过bot自身的http服务发送媒体文件
+# 默认情况下Image会把文件以base64的形式内联到ws消息中，消息体积约为文件的4/3，且序列化大字符串会阻塞事件循环
+# 启用后Image会改为发送一个带有随机token的链接，由协议端通过http获取，链接默认在超过有效期后失效
+# 也可以限制获取次数，只有完整的GET响应才计入，HEAD请求和Range请求不计入，协议端先探测或者分段下载时不会提前失效
+# 每个server持有自己的MediaStore，segment通过当前bot找到所属server的MediaStore
+import asyncio
+import mimetypes
+import os
+import secrets
+import shutil
+import tempfile
+import time
+
+from io import BytesIO
+from typing import BinaryIO, Dict
+
+from quart import abort, request, send_file
+
+
+class _MediaItem:
+    __slots__ = ('source', 'mimetype', 'expire_at', 'remaining', 'temp_path')
+
+    def __init__(self, source: str | BytesIO, mimetype: str, expire_at: float, remaining: int | None,
+                 temp_path: str | None):
+        self.source = source  # 文件路径或内存中的数据
+        self.mimetype = mimetype
+        self.expire_at = expire_at
+        self.remaining = remaining  # 剩余可以获取的次数，为None时不限制
+        self.temp_path = temp_path  # 为了发送而创建的临时文件，失效后删除
+
+
+# 根据文件头判断常见的图片格式，用于没有文件名的流
+_signatures = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+)
+
+
+def _sniff(head: bytes) -> str | None:
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    for signature, mimetype in _signatures:
+        if head.startswith(signature):
+            return mimetype
+    return None
+
+
+class MediaStore:
+    _grace_sec = 30  # 次数用完后延迟删除临时文件，防止删除时文件仍在传输
+
+    # base_url为协议端访问bot所使用的地址，例如http://127.0.0.1:8082，为None时在server启动时根据监听地址生成
+    # max_deliveries为None时链接只按ttl失效
+    def __init__(self, base_url: str | None = None, *, route: str = '/media', ttl: float = 300,
+                 max_deliveries: int | None = None):
+        self.base_url = base_url.rstrip('/') if base_url else None
+        self.route = route
+        self.ttl = ttl
+        self.max_deliveries = max_deliveries
+        self._items: Dict[str, _MediaItem] = {}
+        self._temp_dir: str | None = None
+        self._cleaner: asyncio.Task | None = None
+
+        # 统计数据
+        self.registered = 0
+        self.delivered = 0
+        self.rejected = 0
+
+    def _register(self, source: str | BytesIO, mimetype: str, temp_path: str | None = None) -> str:
+        if self.base_url is None:
+            raise Exception('媒体服务的地址尚未确定，请在启用时指定base_url或者先启动server.')
+        token = secrets.token_urlsafe(24)
+        self._items[token] = _MediaItem(source, mimetype, time.monotonic() + self.ttl, self.max_deliveries, temp_path)
+        self.registered += 1
+        return f'{self.base_url}{self.route}/{token}'
+
+    # 注册一个文件，返回协议端可以访问的链接，文件需要在链接失效前保持存在
+    def register_path(self, path: str | os.PathLike, mimetype: str | None = None) -> str:
+        path = os.fspath(path)
+        if mimetype is None:
+            mimetype = mimetypes.guess_type(path)[0]
+            if mimetype is None:
+                with open(path, 'rb') as f:
+                    mimetype = _sniff(f.read(16)) or 'application/octet-stream'
+        return self._register(path, mimetype)
+
+    # 注册一个文件对象，内存中的数据直接持有，其他的流会在注册时保存一份，之后关闭或者删除原文件都不会影响发送
+    def register_stream(self, stream: BinaryIO, mimetype: str | None = None) -> str:
+        name = getattr(stream, 'name', None)
+        name = name if isinstance(name, str) else None
+        if mimetype is None and name is not None:
+            mimetype = mimetypes.guess_type(name)[0]
+
+        if isinstance(stream, BytesIO):
+            data = stream.getbuffer()
+            if mimetype is None:
+                mimetype = _sniff(bytes(data[:16]))
+            return self._register(BytesIO(data), mimetype or 'application/octet-stream')
+
+        if self._temp_dir is None:
+            self._temp_dir = tempfile.mkdtemp(prefix='lolibot-media-')
+        temp_path = os.path.join(self._temp_dir, secrets.token_hex(16))
+        current_pos = stream.tell()
+        try:
+            # 普通文件优先创建硬链接，不需要复制内容，原文件被删除后链接仍然可用
+            if name is None or not os.path.isfile(name):
+                raise OSError
+            os.link(name, temp_path)
+        except OSError:
+            stream.seek(0)
+            with open(temp_path, 'wb') as f:
+                shutil.copyfileobj(stream, f)
+        if mimetype is None:
+            with open(temp_path, 'rb') as f:
+                mimetype = _sniff(f.read(16))
+        stream.seek(current_pos)
+        return self._register(temp_path, mimetype or 'application/octet-stream', temp_path)
+
+    async def serve(self, token: str):
+        item = self._items.get(token)
+        now = time.monotonic()
+        if item is None or item.remaining is not None and item.remaining <= 0 or item.expire_at < now:
+            self.rejected += 1
+            abort(404)
+
+        source = item.source
+        if isinstance(source, BytesIO):
+            source = BytesIO(source.getbuffer())  # 每次发送使用独立的指针
+        # uvicorn不支持asgi的零拷贝发送扩展，这里由quart按块读取文件，不会把整个文件读入内存
+        response = await send_file(source, mimetype=item.mimetype, conditional=True)
+
+        # 只有完整发送了文件的GET请求才算一次获取
+        if request.method == 'GET' and response.status_code == 200:
+            self.delivered += 1
+            if item.remaining is not None:
+                item.remaining -= 1
+                if item.remaining <= 0:
+                    item.expire_at = now + self._grace_sec
+        return response
+
+    def _remove(self, token: str) -> None:
+        item = self._items.pop(token)
+        if item.temp_path is not None:
+            try:
+                os.remove(item.temp_path)
+            except OSError:
+                pass
+
+    def cleanup(self) -> None:
+        now = time.monotonic()
+        for token in [token for token, item in self._items.items() if item.expire_at < now]:
+            self._remove(token)
+
+    async def _clean_periodically(self, interval: float = 10) -> None:
+        while True:
+            await asyncio.sleep(interval)
+            self.cleanup()
+
+    def start(self, host: str, port: int) -> None:
+        if self.base_url is None:
+            host = '127.0.0.1' if host in ('0.0.0.0', '::', '') else host
+            self.base_url = f'http://{host}:{port}'
+        self._cleaner = asyncio.create_task(self._clean_periodically())
+
+    def close(self) -> None:
+        if self._cleaner is not None:
+            self._cleaner.cancel()
+        for token in list(self._items):
+            self._remove(token)
+        if self._temp_dir is not None:
+            shutil.rmtree(self._temp_dir, ignore_errors=True)
+            self._temp_dir = None
+
+    def stats(self) -> dict:
+        return {'active': len(self._items), 'registered': self.registered, 'delivered': self.delivered,
+                'rejected': self.rejected}
+
@@ -6,6 +6,8 @@
 
 ########################################################################################################################
 class Sender:  # MessageEvent类的数据成员
+    __slots__ = ('group_id', 'role', 'user_id', 'nickname', 'card')
+
     def __init__(self, source: dict):
         self.group_id: int | None = source.get('group_id')
         # private：friend、group、other/group：owner、admin、member
@@ -25,6 +27,8 @@ class Sender:  # MessageEvent类的数据成员
 
 
 class Position:
+    __slots__ = ('obj_id', 'is_group')
+
     def __init__(self, obj_id: int, is_group: bool):
         self.obj_id = obj_id
         self.is_group = is_group
@@ -39,6 +43,8 @@ class Position:
 
 
 class Group(Position):
+    __slots__ = ()
+
     def __init__(self, group_id: int):
         super().__init__(group_id, True)
 
@@ -47,6 +53,8 @@ class Group(Position):
 
 
 class Private(Position):
+    __slots__ = ()
+
     def __init__(self, qq_id: int):
         super().__init__(qq_id, False)
 
@@ -56,110 +64,226 @@ class Private(Position):
 
 ########################################################################################################################
 from io import BytesIO
+from typing import BinaryIO
+
+
+# 按类型整理的消息段索引，在第一次查询时一次遍历建立
+class _SegmentIndex:
+    __slots__ = ('text', 'at_list', 'at_set', 'reply_id', 'images', 'files')
+
+    def __init__(self, content: list['_MessageSegment']):
+        texts = []
+        at_list = []
+        self.reply_id: str | None = None
+        self.images: list['_MessageSegment'] = []
+        self.files: list['_MessageSegment'] = []
+        for seg in content:
+            seg_type = seg.type
+            if seg_type == 'text':
+                if temp := seg.data['text'].strip():
+                    texts.append(temp)
+            elif seg_type == 'at':
+                if seg.data['qq'] != 'all':  # at全体成员不计入
+                    at_list.append(int(seg.data['qq']))
+            elif seg_type == 'reply':
+                if self.reply_id is None:
+                    self.reply_id = seg.data['id']
+            elif seg_type == 'image':
+                self.images.append(seg)
+            elif seg_type == 'file':
+                self.files.append(seg)
+        self.text = ' '.join(texts)
+        self.at_list = at_list
+        self.at_set = frozenset(at_list)
 
 
 # 内部属性可以改用property
 class Message:
+    __slots__ = ('content', 'text', '_index')
+
     def __init__(self, *args: '_MessageSegment'):
         self.content = list(args)
-        self.text = None
+        self.text = None  # 命令解析时会被替换为去掉命令部分的文本
+        self._index: _SegmentIndex | None = None  # 直接修改content后需要调用invalidate
+
+    @classmethod
+    def _from_raw(cls, raw: list[dict]) -> 'Message':
+        return cls(*(_MessageSegment.parse(item) for item in raw))
 
     def __str__(self):
         return "[" + ", ".join(str(segment) for segment in self.content) + "]"
 
+    def invalidate(self) -> None:
+        self._index = None
+
+    def _get_index(self) -> _SegmentIndex:
+        if self._index is None:
+            self._index = _SegmentIndex(self.content)
+        return self._index
+
     def insert_at_front(self, seg: '_MessageSegment'):
         self.content.insert(0, seg)
+        self._index = None
         return self
 
     # 逻辑需要修改以适应命令的解析流程
     def get_plain_text(self) -> str:
         if self.text is None:  # 命令解析有可能导致为空字符串
-            res = ''
-            for seg in self.content:
-                if temp := seg.get_plain_text():
-                    res += temp.strip()
-                    res += ' '
-            self.text = res[:-1]  # 去掉最后的空格
+            self.text = self._get_index().text
         return self.text
 
     def get_at_qq(self) -> list[int]:
-        res = []
-        for seg in self.content:
-            if temp := seg.get_at_qq():
-                res.append(temp)
-        return res
+        return list(self._get_index().at_list)
+
+    def is_at(self, qq_id: int) -> bool:
+        return qq_id in self._get_index().at_set
 
     def get_reply_id(self) -> int | None:  # 如果是回复消息那回复一定在最前面（对吗？）
-        return self.content[0].get_reply_id()
+        return self._get_index().reply_id
 
     async def get_image_route(self) -> list[BytesIO]:
-        res = []
-        for seg in self.content:
-            if temp := await seg.get_image_route():
-                res.append(temp)
-        return res
+        return [await seg.get_image_route() for seg in self._get_index().images]
+
+    # 流式下载消息中的全部图片，内存占用不随图片大小增长，返回的文件使用完毕后需要关闭
+    async def get_image_files(self, max_size: int = 32 * 2 ** 20) -> list[BinaryIO]:
+        return [await seg.get_image_file(max_size) for seg in self._get_index().images]
 
     async def get_file_route(self) -> str | None:  # 文件一定只有一个消息段元素
-        return await self.content[0].get_file_route()
+        if files := self._get_index().files:
+            return await files[0].get_file_route()
 
 
 ########################################################################################################################
-class _Captured(Exception):
-    pass
-
-
 class ResponseTimeout(Exception):
     pass
 
 
 # 需要减少耦合
 from .util.send_msg import send_msg
-from .bot_context import print_log
+from .util.send_scheduler import Priority
+from .bot_context import current_bot, print_log
 
 import asyncio
 
-from typing import Callable
+from typing import Callable, Dict, Tuple
 
+# expect的路由键，(对话位置, 用户qq号)，用户qq号为None时表示匹配该位置下任意用户的消息
+RouteKey = Tuple[Position, int | None]
 
-class MessageEvent:
-    expect_dict = {}  # 用于提供多轮命令对话支持，可以直接读取内容并抛出ResponseTimeout来取消
 
-    async def expect(self, verify_func: Callable[['MessageEvent'], bool],
-                     timeout_sec: int):  # 这里的验证函数应当是根据具体情况定义的内部函数，不会有相同的内存地址
-        future = asyncio.get_event_loop().create_future()
-        MessageEvent.expect_dict[verify_func] = future
+class _Waiter:
+    __slots__ = ('verify_func', 'future')
+
+    def __init__(self, verify_func: Callable[['MessageEvent'], bool] | None):
+        self.verify_func = verify_func
+        self.future = asyncio.get_event_loop().create_future()
 
+    def offer(self, event: 'MessageEvent') -> bool:
+        if self.future.done():  # 已经超时或者被其他消息捕获
+            return False
+        if self.verify_func is None or self.verify_func(event):
+            self.future.set_result(event)
+            return True
+        return False
+
+
+# 每个bot持有一个，用于提供多轮命令对话支持
+# 等待者按路由键分桶存储，收到消息时只检查键匹配的等待者，没有路由键的等待者才需要对每条消息逐一检查
+class _ExpectRegistry:
+    def __init__(self):
+        self._routed: Dict[RouteKey, Dict[_Waiter, None]] = {}  # 用dict代替set以保持注册顺序
+        self._unrouted: Dict[_Waiter, None] = {}
+        self._pending = 0
+
+    def __len__(self) -> int:  # 当前等待中的数量
+        return self._pending
+
+    def add(self, key: RouteKey | None, verify_func: Callable[['MessageEvent'], bool] | None) -> _Waiter:
+        waiter = _Waiter(verify_func)
+        bucket = self._unrouted if key is None else self._routed.setdefault(key, {})
+        bucket[waiter] = None
+        self._pending += 1
+        return waiter
+
+    def remove(self, key: RouteKey | None, waiter: _Waiter) -> None:
+        if key is None:
+            del self._unrouted[waiter]
+        else:
+            bucket = self._routed[key]
+            del bucket[waiter]
+            if not bucket:
+                del self._routed[key]
+        self._pending -= 1
+
+    def dispatch(self, event: 'MessageEvent') -> bool:
+        if not self._pending:
+            return False
+
+        flag = False
+        position = event.position
+        for key in ((position, event.sender.user_id), (position, None)):
+            if bucket := self._routed.get(key):
+                for waiter in list(bucket):  # 防止一边修改一边遍历导致问题
+                    flag |= waiter.offer(event)  # 考虑是否需要break，即保证一次只能触发一条命令继续处理
+        if self._unrouted:
+            for waiter in list(self._unrouted):
+                flag |= waiter.offer(event)
+        return flag
+
+
+# 只依据路由键判断的检查函数，expect时会自动使用其路由键
+class _RouteChecker:
+    __slots__ = ('route_key',)
+
+    def __init__(self, route_key: RouteKey):
+        self.route_key = route_key
+
+    def __call__(self, new: 'MessageEvent') -> bool:
+        position, user_id = self.route_key
+        return new.position == position and (user_id is None or new.sender.user_id == user_id)
+
+
+class MessageEvent:
+    # 等待下一条满足条件的消息，可以直接读取内容并抛出ResponseTimeout来取消
+    # 指定key时只有该位置（和用户）的消息会被检查，verify_func为None表示只按key匹配
+    # 未指定key时会对当前bot收到的每一条消息调用verify_func，开销较大，尽量使用下面几个提供路由键的方法
+    async def expect(self, verify_func: Callable[['MessageEvent'], bool] | None, timeout_sec: int,
+                     *, key: RouteKey | None = None):
+        if isinstance(verify_func, _RouteChecker):
+            key = key or verify_func.route_key
+            verify_func = None
+        elif verify_func is None and key is None:
+            raise Exception('expect需要提供verify_func或者key中的至少一个.')
+
+        bot = current_bot.get()
+        registry = bot.expect_registry
+        waiter = registry.add(key, verify_func)
         try:
-            self.__dict__ = await asyncio.wait_for(future, timeout_sec)
+            with bot.executor.parking():  # 等待回复期间不占用执行器的并发数
+                new = await asyncio.wait_for(waiter.future, timeout_sec)
+            for attr in MessageEvent.__slots__:  # 用新消息的内容替换当前事件
+                setattr(self, attr, getattr(new, attr))
         except asyncio.TimeoutError:
             raise ResponseTimeout(f'Response not received with timeout_sec {timeout_sec}.')
         finally:
-            del MessageEvent.expect_dict[verify_func]
+            registry.remove(key, waiter)
 
-    def _check_expect(self):
-        flag = False
-        for verify_func in list(MessageEvent.expect_dict):  # 防止一遍修改一边遍历导致问题
-            if verify_func(self):  # 考虑是否需要break，即保证一次只能触发一条命令继续处理
-                MessageEvent.expect_dict[verify_func].set_result(self.__dict__)
-                flag = True
-        return flag
+    # 提供几个用于expect检查的方法，返回的检查函数带有路由键
 
-    # 提供几个用于expect检查的方法
+    def sender_key(self) -> RouteKey:
+        return self.position, self.sender.user_id
 
-    def same_sender(self):
-        def checker(new: 'MessageEvent'):
-            return new.sender == self.sender
+    def context_key(self) -> RouteKey:
+        return self.position, None
 
-        return checker
+    def same_sender(self):
+        return _RouteChecker(self.sender_key())
 
     def same_context(self):
-        def checker(new: 'MessageEvent'):
-            if self.sender.group_id:
-                return self.sender.group_id == new.sender.group_id
-            else:
-                return not new.sender.group_id and self.sender.user_id == new.sender.group_id
+        return _RouteChecker(self.context_key())
 
-        return checker
+    # 事件对象数量很多且大部分会被直接丢弃，所以只保存原始数据，sender和message在第一次访问时才构造
+    __slots__ = ('self_id', 'message_id', '_source', '_sender', '_message', '_position')
 
     def __init__(self, source: dict):
         if source['message_format'] != 'array':
@@ -174,37 +298,60 @@ class MessageEvent:
         # self.time: int = source['time']  # 目前暂时没有对这一字段的需求，且可以通过time获取
         self.message_id: int = source['message_id']  # message_seq,real_id字段似乎携带相同信息，将其丢弃
 
-        # 权限控制相关
-        self.sender = Sender(source)
+        # 权限控制相关见sender属性
         # 隐含message_type，如果是私聊消息group_id就是None
         # user_id属性已在sender中包含
         # 由于群聊仅支持normal，将sub_type合并到sender
         # self.sub_type: str = source['sub_type']  # friend、group、other/normal、anonymous、notice
 
-        # 消息内容相关
-        self.message = Message(*list(_MessageSegment(item) for item in source['message']))
+        # 消息内容相关见message属性
         # 这两个不知道用不用得到，先丢了
         # self.font = source['font']
         # self.raw_message = source['raw_message']
+        self._source = source
+        self._sender: Sender | None = None
+        self._message: Message | None = None
+        self._position: Position | None = None
 
-        # print(f'\nReceived {self}')
-        print_log(f'Message id {self.message_id} received from {self.sender}:\n{self.message}')
-
-        if self._check_expect():
-            print_log('Message Captured.')
-            raise _Captured
+        # 日志内容只在真正输出时才格式化，这里直接从原始数据格式化而不访问上面的缓存，避免与命令处理对消息的修改互相影响
+        print_log(lambda: f'Message id {source["message_id"]} received from {Sender(source)}:\n'
+                          f'{_format_raw_message(source["message"])}', hot=True)
 
     # def __str__(self):
     #     return f'Message(time={self.time}, msg_id={self.message_id}, sender={self.sender}, message={self.message})'
 
+    @property
+    def sender(self) -> Sender:
+        if self._sender is None:
+            self._sender = Sender(self._source)
+        return self._sender
+
+    @sender.setter
+    def sender(self, value: Sender):
+        self._sender = value
+
+    @property
+    def message(self) -> Message:
+        if self._message is None:
+            self._message = Message._from_raw(self._source['message'])
+        return self._message
+
+    @message.setter
+    def message(self, value: Message):
+        self._message = value
+
     @property
     def position(self) -> Position:
-        if gid := self.sender.group_id:  # 群号不会为0
-            return Group(gid)
-        else:
-            return Private(self.sender.user_id)
+        if self._position is None:
+            source = self._source
+            if gid := source.get('group_id'):  # 群号不会为0
+                self._position = Group(gid)
+            else:
+                self._position = Private(source['sender']['user_id'])
+        return self._position
 
-    async def send(self, message: Message | str, *, reply: bool = True, at_sender: bool = True):
+    async def send(self, message: Message | str, *, reply: bool = True, at_sender: bool = True,
+                   priority: int = Priority.NORMAL):
         # 暂不清楚file的发送限制，是否可以加at或者reply或者一次发多个
         if isinstance(message, Message):
             if isinstance(message.content[0], File):
@@ -224,32 +371,84 @@ class MessageEvent:
         if reply:
             message.insert_at_front(Reply(self.message_id))
 
-        return await send_msg(self.position, message)
+        return await send_msg(self.position, message, priority=priority)
 
 
 ########################################################################################################################
-import base64
-from typing import BinaryIO
+import binascii
+import io
+import os
+
+from .codec import AsciiBuffer
+
+_BASE64_PREFIX = b'base64://'
+_BASE64_CHUNK = 3 * 2 ** 16  # 3的倍数，完整读取的块可以直接编码拼接
+
+
+# 分块读取并编码为ascii字节串（带base64://前缀），结果直接写入预先分配好的缓冲区，峰值内存约为编码结果本身
+def bytes2base64(self: BinaryIO) -> bytearray:
+    try:
+        current_pos = self.tell()  # 记录当前指针位置
+        size = self.seek(0, io.SEEK_END)
+        self.seek(0)  # 将指针移动到文件开头
+    except (OSError, io.UnsupportedOperation):  # 不能随机访问的流只能从当前位置读到结尾，缓冲区随读取增长
+        current_pos = size = None
+
+    buffer = bytearray(_BASE64_PREFIX) if size is None else bytearray(len(_BASE64_PREFIX) + (size + 2) // 3 * 4)
+    buffer[:len(_BASE64_PREFIX)] = _BASE64_PREFIX
+    offset = len(_BASE64_PREFIX)
+    rest = b''
+    while chunk := self.read(_BASE64_CHUNK):
+        if rest:
+            chunk = rest + chunk
+        # 管道、socket等流可能返回任意长度，只编码3的倍数的部分，剩余的字节留到下一块，否则会在中间产生填充
+        cut = len(chunk) - len(chunk) % 3
+        rest = chunk[cut:]
+        if cut:
+            encoded = binascii.b2a_base64(memoryview(chunk)[:cut], newline=False)
+            buffer[offset:offset + len(encoded)] = encoded
+            offset += len(encoded)
+    if rest:
+        encoded = binascii.b2a_base64(rest, newline=False)
+        buffer[offset:offset + len(encoded)] = encoded
+        offset += len(encoded)
+    del buffer[offset:]  # 读取过程中文件变短时去掉多余的部分
+
+    if current_pos is not None:
+        self.seek(current_pos)  # 恢复指针位置
+    return buffer
+
+
+# 需要str时使用，转换会多复制一份，发送的Image直接使用上面的字节串
+def bytes2base64str(self: BinaryIO) -> str:
+    return bytes2base64(self).decode('ascii')
 
 
-def bytes2base64str(self: BinaryIO) -> str:
-    current_pos = self.tell()  # 记录当前指针位置
-    self.seek(0)  # 将指针移动到文件开头
-    data = self.read()  # 读取全部数据
-    self.seek(current_pos)  # 恢复指针位置
-    return 'base64://' + base64.b64encode(data).decode('utf-8')
+def _format_raw_message(raw: list[dict]) -> str:  # 与str(Message)的结果一致，但不需要构造消息段对象
+    return "[" + ", ".join(f"{item['type']}({item['data']})" for item in raw) + "]"
 
 
-from .util.get_image import get_image
+from .util.get_image import get_image, download_image
 from .util.get_file import get_file
+from .media import MediaStore
+
 
+class _MessageSegment(dict):
+    __slots__ = ('type', 'data')
 
-class _MessageSegment(dict):  # 是否需要在接收消息时直接构造子类对象？
     def __init__(self, source: dict):
         super().__init__(source)
         self.type: str = self['type']
         self.data: dict = self['data']
 
+    # 接收消息时按类型直接构造对应的子类对象，不经过子类用于发送的构造函数，没有对应子类的类型使用基类
+    @staticmethod
+    def parse(source: dict) -> '_MessageSegment':
+        seg_cls = _segment_types.get(source['type'], _MessageSegment)
+        seg = seg_cls.__new__(seg_cls)
+        _MessageSegment.__init__(seg, source)
+        return seg
+
     def __str__(self):
         return f"{self.type}({self.data})"
 
@@ -270,41 +469,94 @@ class _MessageSegment(dict):  # 是否需要在接收消息时直接构造子类
         if self.type == 'image':
             return BytesIO(await get_image(self.data['url']))
 
+    # 注意该方法不能作用于子类手动构造的image对象上，否则会引发异常
+    async def get_image_file(self, max_size: int = 32 * 2 ** 20) -> BinaryIO | None:
+        if self.type == 'image':
+            return await download_image(self.data['url'], max_size=max_size)
+
     # 注意该方法不能作用于子类手动构造的file对象上，否则会引发异常
     async def get_file_route(self) -> str | None:
         if self.type == 'file':
             return await get_file(self.data['file_id'])
 
 
+# 当前bot所属server的媒体服务，不在bot的上下文中或者没有启用时为None
+def _current_media_store() -> 'MediaStore | None':
+    bot = current_bot.get(None)
+    return bot.media_store if bot is not None else None
+
+
+def _media_store() -> 'MediaStore':
+    if (store := _current_media_store()) is None:
+        raise Exception('媒体服务未启用，请先调用server的enable_media_hosting方法.')
+    return store
+
+
 class Text(_MessageSegment):
+    __slots__ = ()
+
     def __init__(self, text: str):
         super().__init__({'type': 'text', 'data': {'text': text}})
 
 
 class At(_MessageSegment):
+    __slots__ = ()
+
     def __init__(self, qq_id: int):
         super().__init__({'type': 'at', 'data': {'qq': f'{qq_id}'}})
 
 
 class Reply(_MessageSegment):
+    __slots__ = ()
+
     def __init__(self, msg_id: int):
         super().__init__({'type': 'reply', 'data': {'id': f'{msg_id}'}})
 
 
 class Image(_MessageSegment):
-    def __init__(self, file: BinaryIO):
-        super().__init__({'type': 'image', 'data': {'file': bytes2base64str(file)}})
+    __slots__ = ()
+
+    # file可以是文件对象，也可以是文件路径
+    # serve为True时通过server的媒体服务发送链接而不是内联base64，默认在server启用了媒体服务时使用
+    def __init__(self, file: BinaryIO | str | os.PathLike, *, serve: bool | None = None):
+        if serve is None:
+            serve = _current_media_store() is not None
+        if serve:
+            data = _media_store().register_path(file) if isinstance(file, (str, os.PathLike)) \
+                else _media_store().register_stream(file)
+        elif isinstance(file, (str, os.PathLike)):  # 编码时直接拼接到ws消息中，不转换为str
+            with open(file, 'rb') as f:
+                data = AsciiBuffer(bytes2base64(f))
+        else:
+            data = AsciiBuffer(bytes2base64(file))
+        super().__init__({'type': 'image', 'data': {'file': data}})
 
-    def __str__(self):
-        return 'Image'
+    def __str__(self):  # 发送的图片内容可能是很长的base64，只有接收到的图片才输出完整内容
+        return super().__str__() if 'url' in self.data else 'Image'
 
 
 class File(_MessageSegment):
-    def __init__(self, file: str):
-        super().__init__({'type': 'file', 'data': {'file': file}})
+    __slots__ = ()
+
+    # 默认file为协议端能够访问到的文件路径，serve为True时file为bot本地的路径，通过server的媒体服务发送链接
+    def __init__(self, file: str, *, serve: bool = False):
+        if serve:
+            data = {'file': _media_store().register_path(file), 'name': os.path.basename(file)}
+        else:
+            data = {'file': file}
+        super().__init__({'type': 'file', 'data': data})
 
     def __str__(self):
-        return 'File'
+        return super().__str__() if 'file_id' in self.data else 'File'
+
+
+_segment_types: dict[str, type[_MessageSegment]] = {
+    'text': Text,
+    'at': At,
+    'reply': Reply,
+    'image': Image,
+    'file': File,
+}
 
 
 ########################################################################################################################
@@ -0,0 +1,175 @@
+# 运行指标，包括计数器、仪表和固定分桶的直方图，可以通过Server.enable_metrics以prometheus文本格式导出
+# 所有指标只在事件循环所在的线程中更新，不加锁；记录一次只是几次字典查找和加法，可以放在热路径上
+import abc
+import bisect
+import time
+
+from typing import Callable, Dict, Iterable, List, Tuple
+
+_Labels = Tuple[str, ...]
+
+# 默认分桶，单位为秒，覆盖从毫秒级的命令解析到数十秒的api调用
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Tuple[str, ...], values: _Labels, extra: str = '') -> str:
+    items = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        items.append(extra)
+    return '{' + ','.join(items) + '}' if items else ''
+
+
+def _format_value(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+_Collector = Callable[[], Iterable[Tuple[_Labels, float]]]
+
+
+class _Metric(abc.ABC):
+    type = ''
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}', *self._samples()]
+
+    @abc.abstractmethod
+    def _samples(self) -> Iterable[str]:
+        ...
+
+
+# 计数器和仪表的值也可以在导出时通过回调函数读取，回调函数返回(标签值, 数值)的序列，用于导出各组件已有的统计数据
+class Counter(_Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (), func: _Collector | None = None):
+        super().__init__(name, documentation, labels)
+        self._values: Dict[_Labels, float] = {}
+        self.func = func
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def _samples(self) -> Iterable[str]:
+        items = self._values.items() if self.func is None else self.func()
+        for labels, value in items:
+            yield f'{self.name}{_format_labels(self.labels, labels)} {_format_value(value)}'
+
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value: float, *labels: str) -> None:
+        self._values[labels] = value
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._counts: Dict[_Labels, List[int]] = {}  # 每个桶单独计数，导出时再累加，最后一项为+Inf
+        self._sums: Dict[_Labels, float] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        if (counts := self._counts.get(labels)) is None:
+            counts = self._counts[labels] = [0] * (len(self.buckets) + 1)
+            self._sums[labels] = 0.0
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sums[labels] += value
+
+    # 用于with语句，记录代码块的执行时间
+    def time(self, *labels: str) -> '_Timer':
+        return _Timer(self, labels)
+
+    def count(self, *labels: str) -> int:
+        return sum(self._counts.get(labels, ()))
+
+    def _samples(self) -> Iterable[str]:
+        for labels, counts in self._counts.items():
+            total = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                total += count
+                extra = f'le="{_format_value(bound)}"'
+                yield f'{self.name}_bucket{_format_labels(self.labels, labels, extra)} {total}'
+            yield f'{self.name}_sum{_format_labels(self.labels, labels)} {_format_value(self._sums[labels])}'
+            yield f'{self.name}_count{_format_labels(self.labels, labels)} {total}'
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram: Histogram, labels: _Labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, *self.labels)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+
+    def _add(self, metric: _Metric) -> _Metric:
+        if metric.name in self._metrics:
+            raise Exception(f'指标 {metric.name} 已经存在，无法重复注册.')
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                func: _Collector | None = None) -> Counter:
+        return self._add(Counter(name, documentation, labels, func))
+
+    def gauge(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+              func: _Collector | None = None) -> Gauge:
+        return self._add(Gauge(name, documentation, labels, func))
+
+    def histogram(self, name: str, documentation: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, documentation, labels, buckets))
+
+    def get(self, name: str) -> _Metric | None:
+        return self._metrics.get(name)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# 框架内置的指标，插件可以在registry上注册自己的指标
+registry = MetricsRegistry()
+
+events_received = registry.counter('lolibot_events_received_total', 'Decoded events by bot and post_type.',
+                                   ('bot', 'post_type'))
+commands_dispatched = registry.counter('lolibot_commands_dispatched_total', 'Commands matched and dispatched.',
+                                       ('bot', 'command'))
+handler_duration = registry.histogram('lolibot_command_duration_seconds', 'Command handler duration.',
+                                      ('command',))
+handler_errors = registry.counter('lolibot_command_errors_total', 'Command handlers ending with an exception.',
+                                  ('command',))
+api_latency = registry.histogram('lolibot_api_latency_seconds', 'OneBot api round-trip latency by action.',
+                                 ('action',))
+api_timeouts = registry.counter('lolibot_api_timeouts_total', 'OneBot api calls that timed out by action.',
+                                ('action',))
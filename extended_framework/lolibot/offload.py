@@ -0,0 +1,149 @@
+# 把耗费cpu的处理函数放到进程池或线程池中执行，避免阻塞同时为所有bot收发消息的事件循环
+# 进程池中的函数按(模块名, 名称)注册，工作进程通过导入对应模块找到函数，所以函数必须定义在可以导入的模块中
+# 工作进程中没有bot和连接，函数只能接收可以pickle的参数，不能调用api或者发送消息
+import asyncio
+import concurrent.futures
+import functools
+import importlib
+import multiprocessing
+import os
+
+from typing import Any, Callable, Dict, Tuple
+
+from .message import MessageEvent, Sender
+
+# 下面的配置在池第一次创建时读取，需要在服务启动前修改
+process_workers: int | None = None  # 进程池大小，None表示cpu核数
+thread_workers: int | None = None  # 线程池大小，None使用标准库的默认值
+task_timeout: float | None = 60  # 单个任务的默认超时时间，超时后不再等待结果，但已经开始的任务无法中断
+warm_up: bool = True  # 服务启动时预先启动全部工作进程并导入注册了函数的模块
+warm_modules: list[str] = []  # 工作进程启动时额外预先导入的模块，比如插件依赖的大型第三方库
+mp_context: str = 'spawn'  # 主进程中有日志等后台线程，fork可能导致死锁，默认使用spawn
+
+_Key = Tuple[str, str]
+
+_registry: Dict[_Key, Callable] = {}
+_process_modules: Dict[str, None] = {}  # 注册了进程池函数的模块，按注册顺序排列
+_process_pool: concurrent.futures.ProcessPoolExecutor | None = None
+_thread_pool: concurrent.futures.ThreadPoolExecutor | None = None
+_in_worker = False
+
+
+class OffloadTimeout(Exception):
+    pass
+
+
+# 传给池中处理函数的事件数据，只包含可以pickle的内容
+class EventData:
+    __slots__ = ('self_id', 'message_id', 'sender', 'text', 'segments')
+
+    def __init__(self, event: MessageEvent):
+        self.self_id: int = event.self_id
+        self.message_id: int = event.message_id
+        self.sender: Sender = event.sender
+        self.text: str = event.message.get_plain_text()  # 命令触发时为去掉命令部分的文本
+        self.segments: list[dict] = event._source['message']  # 原始的消息段列表
+
+    def __repr__(self):
+        return f'EventData(message_id={self.message_id}, sender={self.sender}, text={self.text!r})'
+
+
+def in_worker() -> bool:
+    return _in_worker
+
+
+def register(key: _Key, func: Callable, executor: str) -> None:
+    _registry[key] = func
+    if executor == 'process':
+        _process_modules[key[0]] = None
+
+
+def _init_worker(modules: list[str]) -> None:
+    global _in_worker
+    _in_worker = True
+    for module in modules:
+        importlib.import_module(module)
+
+
+def _call_registered(key: _Key, args: tuple, kwargs: dict) -> Any:
+    if (func := _registry.get(key)) is None:
+        importlib.import_module(key[0])  # 导入模块时会重新注册其中的函数
+        func = _registry[key]
+    return func(*args, **kwargs)
+
+
+def _ping() -> int:
+    return os.getpid()
+
+
+def _get_pool(executor: str) -> concurrent.futures.Executor:
+    global _process_pool, _thread_pool
+    if executor == 'process':
+        if _process_pool is None:
+            modules = list(dict.fromkeys(warm_modules + list(_process_modules)))
+            _process_pool = concurrent.futures.ProcessPoolExecutor(
+                process_workers, mp_context=multiprocessing.get_context(mp_context),
+                initializer=_init_worker, initargs=(modules,))
+        return _process_pool
+    if executor == 'thread':
+        if _thread_pool is None:
+            _thread_pool = concurrent.futures.ThreadPoolExecutor(thread_workers, thread_name_prefix='offload')
+        return _thread_pool
+    raise Exception(f'未知的executor类型 {executor}，只支持process和thread.')
+
+
+# 在池中执行已注册的函数，线程池直接调用函数本身
+async def run_registered(executor: str, key: _Key, *args, timeout: float | None = ..., **kwargs) -> Any:
+    if executor == 'thread':
+        future = _get_pool(executor).submit(functools.partial(_registry[key], *args, **kwargs))
+    else:
+        future = _get_pool(executor).submit(_call_registered, key, args, kwargs)
+
+    timeout = task_timeout if timeout is ... else timeout
+    try:
+        return await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+    except asyncio.TimeoutError:
+        raise OffloadTimeout(f'{key[0]}.{key[1]} did not finish within {timeout}s.')
+
+
+# 装饰器，把模块顶层的同步函数变为在池中执行的异步函数，适合在命令处理函数中只把计算部分放到池中
+def offload(executor: str = 'process', *, timeout: float | None = ...):
+    def deco(func: Callable):
+        key = (func.__module__, func.__qualname__)
+        register(key, func, executor)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await run_registered(executor, key, *args, timeout=timeout, **kwargs)
+
+        return wrapper
+
+    return deco
+
+
+# 启动全部工作进程，避免第一个任务承担进程启动和导入模块的开销
+async def start() -> None:
+    if warm_up and not _in_worker and (warm_modules or _process_modules):
+        pool = _get_pool('process')
+        workers = process_workers or os.cpu_count() or 1
+        await asyncio.gather(*(asyncio.wrap_future(pool.submit(_ping)) for _ in range(workers)))
+
+
+# 插件热重载后调用，工作进程中已经导入的仍然是旧代码，需要换一个新的进程池重新导入
+# 已经提交的任务继续在旧进程中执行完，之后旧进程退出，新进程在下一个任务提交时按需启动
+def recycle(module_route: str) -> bool:
+    global _process_pool
+    if _process_pool is None or not any(
+            module == module_route or module.startswith(module_route + '.') for module in _process_modules):
+        return False
+    pool, _process_pool = _process_pool, None
+    pool.shutdown(wait=False)
+    return True
+
+
+def shutdown() -> None:
+    global _process_pool, _thread_pool
+    for pool in (_process_pool, _thread_pool):
+        if pool is not None:
+            pool.shutdown(wait=False, cancel_futures=True)
+    _process_pool = _thread_pool = None
@@ -0,0 +1,183 @@
+# 插件的查找与加载
+# 加载前可以先在线程池中并发导入各插件依赖的第三方库（预热），之后再按固定顺序逐个导入插件本身，
+# 这样插件注册命令的顺序是确定的，而耗时较长的依赖导入可以并行进行
+# 每个插件的导入耗时和内存变化会记录在加载报告中
+import ast
+import importlib
+import importlib.util
+import json
+import logging
+import os
+import sys
+import time
+import tracemalloc
+import traceback
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
+
+from .bot_context import print_log
+
+
+def find_modules(plugin_folder: str, prefix: str = '') -> List[Tuple[str, str]]:
+    to_import: list[tuple[str, str]] = []
+
+    # 将路径转换为模块名时，使用 os.path.sep 动态替换
+    normalized_folder = plugin_folder.replace(os.path.sep, '.')
+
+    # 排序以保证不同系统上的加载顺序一致
+    for filename in sorted(os.listdir(plugin_folder)):
+        file_path = os.path.join(plugin_folder, filename)
+
+        # 检查是否是Python文件
+        if filename.endswith('.py') and filename != '__init__.py':
+            filename = filename[:-3]
+            to_import.append((f'{prefix}{filename}', f'{normalized_folder}.{filename}'))
+
+        # 检查是否是包
+        elif os.path.isdir(file_path) and filename != '__pycache__':
+            to_import.extend(find_modules(file_path, f'{prefix}{filename}.'))
+
+    return to_import
+
+
+class PluginLoadRecord:
+    __slots__ = ('name', 'route', 'ok', 'seconds', 'memory_delta', 'error')
+
+    def __init__(self, name: str, route: str):
+        self.name = name
+        self.route = route
+        self.ok = False
+        self.seconds = 0.0
+        self.memory_delta: int | None = None  # 字节数，未开启内存统计时为None
+        self.error: str | None = None
+
+    def to_dict(self) -> dict:
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+
+class PluginLoadReport:
+    def __init__(self, records: List[PluginLoadRecord], warm_seconds: float, total_seconds: float):
+        self.records = records
+        self.warm_seconds = warm_seconds  # 预热依赖的耗时
+        self.total_seconds = total_seconds
+
+    # sort_by可以是seconds、memory_delta或name
+    def table(self, sort_by: str = 'seconds') -> str:
+        if sort_by == 'name':
+            records = sorted(self.records, key=lambda r: r.name)
+        else:
+            records = sorted(self.records, key=lambda r: getattr(r, sort_by) or 0, reverse=True)
+
+        width = max([len(r.name) for r in records] + [6])
+        lines = [f'{"plugin":<{width}}  status  time(ms)  memory(KiB)']
+        for r in records:
+            memory = f'{r.memory_delta / 1024:>11.1f}' if r.memory_delta is not None else f'{"-":>11}'
+            lines.append(f'{r.name:<{width}}  {"ok" if r.ok else "failed":<6}  {r.seconds * 1000:>8.1f}  {memory}')
+        lines.append(f'warm-up {self.warm_seconds * 1000:.1f} ms, total {self.total_seconds * 1000:.1f} ms')
+        return '\n'.join(lines)
+
+    def to_dict(self) -> dict:
+        return {
+            'warm_seconds': self.warm_seconds,
+            'total_seconds': self.total_seconds,
+            'plugins': [r.to_dict() for r in self.records],
+        }
+
+    def save(self, path: str) -> None:
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+
+
+def _module_file(module_route: str) -> str | None:
+    try:
+        spec = importlib.util.find_spec(module_route)
+    except (ImportError, ValueError):
+        return None
+    return spec.origin if spec is not None else None
+
+
+# 只收集模块顶层（包括顶层的if/try中）的绝对导入，函数内部的导入不会在加载时执行
+def _top_level_imports(path: str) -> List[str]:
+    try:
+        with open(path, 'rb') as f:
+            tree = ast.parse(f.read(), path)
+    except (OSError, SyntaxError, ValueError):
+        return []
+
+    res = []
+    body = list(tree.body)
+    while body:
+        node = body.pop(0)
+        if isinstance(node, ast.Import):
+            res.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            res.append(node.module)
+        elif isinstance(node, (ast.If, ast.Try)):
+            body.extend(node.body)
+            body.extend(node.orelse)
+            if isinstance(node, ast.Try):
+                for handler in node.handlers:
+                    body.extend(handler.body)
+                body.extend(node.finalbody)
+    return res
+
+
+def _try_import(module_name: str) -> None:
+    try:
+        importlib.import_module(module_name)
+    except (Exception, SystemExit):  # 预热失败不影响加载，插件导入时会再次尝试并报告错误，KeyboardInterrupt照常抛出
+        pass
+
+
+# 在线程池中并发导入插件依赖的第三方库，插件自身以及框架的模块不在这里导入
+def _warm_imports(plugin_routes: List[Tuple[str, str]], max_workers: int) -> None:
+    own_roots = {route.split('.')[0] for _, route in plugin_routes} | {__name__.split('.')[0]}
+    candidates = []
+    for _, module_route in plugin_routes:
+        if (path := _module_file(module_route)) is None:
+            continue
+        for module_name in _top_level_imports(path):
+            if module_name.split('.')[0] not in own_roots and module_name not in sys.modules \
+                    and module_name not in candidates:
+                candidates.append(module_name)
+
+    if candidates:
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='plugin-warm') as pool:
+            list(pool.map(_try_import, candidates))
+
+
+def load_plugins(plugin_routes: List[Tuple[str, str]], *, warm_imports: bool = True, warm_workers: int = 8,
+                 profile_memory: bool = False) -> PluginLoadReport:
+    start = time.perf_counter()
+    if warm_imports:
+        _warm_imports(plugin_routes, warm_workers)
+    warm_seconds = time.perf_counter() - start
+
+    # tracemalloc会明显拖慢导入速度，所以只在需要时开启
+    stop_tracing = profile_memory and not tracemalloc.is_tracing()
+    if stop_tracing:
+        tracemalloc.start()
+
+    records = []
+    try:
+        for module_name, module_route in plugin_routes:
+            record = PluginLoadRecord(module_name, module_route)
+            memory_before = tracemalloc.get_traced_memory()[0] if profile_memory else 0
+            plugin_start = time.perf_counter()
+            try:
+                importlib.import_module(module_route)
+                record.ok = True
+                print_log(f'Successfully loaded plugin {module_name}.')
+            except (Exception, SystemExit):  # 插件在导入时调用sys.exit()也只算加载失败，不影响其他插件
+                record.error = traceback.format_exc()
+                print_log(f'Error while loading plugin {module_name}:\n{record.error}', logging.ERROR)
+            record.seconds = time.perf_counter() - plugin_start
+            if profile_memory:
+                record.memory_delta = tracemalloc.get_traced_memory()[0] - memory_before
+            records.append(record)
+    finally:
+        if stop_tracing:
+            tracemalloc.stop()
+
+    return PluginLoadReport(records, warm_seconds, time.perf_counter() - start)
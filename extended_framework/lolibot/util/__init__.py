@@ -1,18 +1,13 @@
 # 由于同时加载util中的所有模块会导致循环引用，所以拆出来之后分别导入
-from .. import Payload, websocket, json
+from .. import Payload, codec, metrics
+from ..bot_context import current_bot, current_connection, print_log
 import asyncio
+import itertools
+import logging
+import time
 
-
-# 为每次api调用生成序列号，以识别返回结果的对应关系
-class _SequenceGenerator:
-    _seq = -1
-    _lock = asyncio.Lock()
-
-    @classmethod
-    async def next(cls) -> int:
-        async with cls._lock:
-            cls._seq = (cls._seq + 1) % 2147483647
-            return cls._seq + 1  # 不能返回0，不然result存储类的add方法会出问题
+from collections import OrderedDict
+from typing import Dict
 
 
 class ApiTimeout(Exception):
@@ -23,44 +18,160 @@ class ApiFailure(Exception):
     pass
 
 
-# 存储api返回的结果，以实现异步操作
-class _ResultStore:
-    _futures = {}
+# 调用确定没有发送给协议端（连接已经断开或者发送失败），可以安全地重新发送
+class ApiNotSent(ApiFailure):
+    pass
 
-    @classmethod
-    def add(cls, result: Payload) -> None:
-        # 注意这个函数并不在命令处理的调用栈中，所以在这里抛出异常并不能被捕获
-        seq = result['echo']  # 有出现过api调用失败返回没有echo字段的情况
-        if future := cls._futures.get(seq):
-            future.set_result(result)
 
-    # 这个原来在__init__下的，现在改为单独配置超时时间，用不到了
-    # 可能需要自定义配置
-    # api_timeout: int = 8
+# api调用的多路复用器，每个反向ws连接持有一个，存储该连接上等待中的api调用，以实现异步操作
+# 不同连接之间的序列号和结果互相独立，不会串台
+class _ApiMultiplexer:
+    _recent_size = 1024  # 记录最近结束的调用数量，用于区分迟到、重复和无主的响应
+
+    def __init__(self, ws, max_in_flight: int = 64, self_id: int | None = None, *, binary: bool = False):
+        self._ws = ws  # 直接持有连接对象，发送时不依赖quart的请求上下文
+        self.self_id = self_id
+        self.binary = binary
+        # 为每次api调用生成序列号，以识别返回结果的对应关系
+        # itertools.count的next在GIL下是原子的，且这里没有await，不需要加锁
+        self._seq = itertools.count()
+        self._futures: Dict[int, asyncio.Future] = {}
+        self._recent: OrderedDict[int, bool] = OrderedDict()  # 序列号 -> 调用方是否没有等到响应（超时或被取消）
+        # 同时等待响应的调用数量上限，超出的调用按顺序排队
+        self._in_flight_limit = asyncio.Semaphore(max_in_flight)
+        self.closed = False
+
+        # 统计数据
+        self.total = 0
+        self.queued = 0
+        self.timeouts = 0
+        self.cancelled = 0  # 等待响应时被取消的调用，比如hedge中输掉的请求
+        self.late = 0  # 调用方超时或被取消之后才到达的响应
+        self.duplicates = 0  # 同一序列号的重复响应
+        self.orphans = 0  # 没有echo或者echo无法对应到任何调用的响应
+
+    def _next_echo(self) -> int:
+        return next(self._seq) % 2147483647 + 1  # 不能返回0，协议端可能会把0当作没有echo
+
+    @property
+    def outstanding(self) -> int:
+        return len(self._futures)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'total': self.total,
+            'outstanding': self.outstanding,
+            'queued': self.queued,
+            'timeouts': self.timeouts,
+            'cancelled': self.cancelled,
+            'late': self.late,
+            'duplicates': self.duplicates,
+            'orphans': self.orphans,
+        }
+
+    async def call(self, action_name: str, params: dict, timeout_sec: float) -> Payload:
+        if self.closed:
+            raise ApiNotSent('连接已断开，无法调用api.')
+
+        self.queued += 1
+        try:
+            await self._in_flight_limit.acquire()
+        finally:
+            self.queued -= 1
 
-    @classmethod
-    async def fetch(cls, seq: int, timeout_sec: float) -> Payload:
-        future = asyncio.get_event_loop().create_future()
-        cls._futures[seq] = future
         try:
-            # 是否需要使用shield
-            return await asyncio.wait_for(future, timeout_sec)
-        except asyncio.TimeoutError:
-            raise ApiTimeout(f'API call timeout with timeout_sec {timeout_sec}.')
+            echo = self._next_echo()
+            future = asyncio.get_event_loop().create_future()
+            self._futures[echo] = future
+            self.total += 1
+            abandoned = False
+            try:
+                # 如果需要标记每个连接，可以通过self_id获取当前连接实现的qq号
+                action = {'action': action_name, 'params': params, 'echo': echo}
+                start = time.perf_counter()
+                try:
+                    await self._ws.send(codec.codec.dumps(action) if self.binary else codec.codec.dumps_text(action))
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    raise ApiNotSent(f'API call {action_name} could not be sent: {e!r}') from e
+                # 是否需要使用shield
+                result = await asyncio.wait_for(future, timeout_sec)
+                metrics.api_latency.observe(time.perf_counter() - start, action_name)
+                return result
+            except asyncio.CancelledError:
+                abandoned = True
+                self.cancelled += 1
+                raise
+            except asyncio.TimeoutError:
+                abandoned = True
+                self.timeouts += 1
+                metrics.api_timeouts.inc(action_name)
+                raise ApiTimeout(f'API call {action_name} timeout with timeout_sec {timeout_sec}.')
+            finally:
+                del self._futures[echo]
+                self._recent[echo] = abandoned
+                if len(self._recent) > self._recent_size:
+                    self._recent.popitem(last=False)
         finally:
-            del cls._futures[seq]
+            self._in_flight_limit.release()
+
+    def resolve(self, result: Payload) -> None:
+        # 注意这个函数并不在命令处理的调用栈中，所以在这里抛出异常并不能被捕获，所有异常情况只做计数
+        if (echo := result.get('echo')) is None:  # 有出现过api调用失败返回没有echo字段的情况
+            self.orphans += 1
+            print_log(f'Received api response without echo:\n{result}', logging.WARNING)
+            return
+
+        if (future := self._futures.get(echo)) is None:
+            if (abandoned := self._recent.get(echo)) is None:
+                self.orphans += 1
+            elif abandoned:
+                self.late += 1
+            else:
+                self.duplicates += 1
+        elif future.cancelled():  # 调用方已经取消，还没有来得及清理
+            self.late += 1
+        elif future.done():
+            self.duplicates += 1
+        else:
+            future.set_result(result)
+
+    def close(self) -> None:
+        # 连接断开时让等待中的调用立即失败，而不是等到超时
+        self.closed = True
+        for future in self._futures.values():
+            if not future.done():
+                future.set_exception(ApiFailure('连接已断开，api调用被取消.'))
 
 
 # 调用这个函数来实现onebot(v11)接口，接口说明文档可见于https://github.com/botuniverse/onebot-11/
+# timeout为该调用的最长超时时间，bot启用了api_timeouts时实际的超时时间会根据最近的延迟调整
 async def _call_onebot_api(action_name: str, params: dict, timeout: float) -> Payload | None:
-    seq = await _SequenceGenerator.next()
-    # print(f'Calling onebot api {action_name} with seq {seq}...')
-
-    # 基于quart的上下文机制，应当能够自动处理ws连接的调用，不会出现多个连接处理串台发送的情况
-    # 如果需要标记每个连接，可以通过websocket.headers['X-Self-ID']获取当前连接实现的qq号
-    await websocket.send(json.dumps({'action': f'{action_name}', 'params': params, 'echo': seq}))
-
-    result = await _ResultStore.fetch(seq, timeout)
+    # 连接对象由bot在收到连接时设置，消息处理函数的task会继承这个上下文，不会出现多个连接处理串台发送的情况
+    if (connection := current_connection.get(None)) is None:
+        raise ApiFailure('当前上下文中没有可用的连接.')
+
+    bot = current_bot.get(None)
+    # 连接断开之前开始执行的处理函数仍然持有旧的连接，协议端已经重新连接时改用新的连接
+    if connection.closed and bot is not None and (live := bot.connections.get(connection.self_id)) is not None \
+            and not live.closed:
+        connection = live
+    # 连接断开时，可以排队的调用进入bot的发送队列，队列中还有调用时新的调用也要排在后面以保证顺序
+    if (outbox := bot.outbox if bot is not None else None) is not None and not outbox.accepts(action_name):
+        outbox = None
+    if outbox is not None and (connection.closed or outbox.pending(connection.self_id)):
+        result = await outbox.send(connection.self_id, action_name, params, connection)
+    else:
+        try:
+            if bot is not None and (timeouts := bot.api_timeouts) is not None:
+                result = await timeouts.call(connection, action_name, params, timeout)
+            else:
+                result = await connection.call(action_name, params, timeout)
+        except ApiNotSent:
+            if outbox is None:
+                raise
+            result = await outbox.send(connection.self_id, action_name, params)
     if result['status'] == 'failed':
         raise ApiFailure(f'Api call failed with message:\n{result["message"]}')
 
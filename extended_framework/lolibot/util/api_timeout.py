@@ -0,0 +1,173 @@
+# 按action统计api调用的延迟，根据最近的p99动态计算超时时间，协议端变快时卡住的调用可以更早失败
+# 幂等的action（默认为get_、can_开头的查询类api）可以配置超时重试，或者在响应较慢时再发一次请求（hedge），取先返回的结果
+# 发送消息等非幂等的action永远不会被重试或者重复发送，默认也不调整超时时间，以免协议端偶尔变慢时消息被判定为发送失败
+import asyncio
+import time
+
+from collections import deque
+from typing import Deque, Dict, Tuple
+
+from . import ApiTimeout
+from .. import Payload
+
+_size_dependent = tuple(name + suffix for name in ('get_file', 'get_group_member_list', 'get_friend_list',
+                                                    'get_group_list', 'get_forward_msg') for suffix in ('', '_async'))
+
+
+class ApiPolicy:
+    # floor和ceiling为超时时间的上下限，ceiling为None时使用调用处指定的超时时间，adaptive为False时直接使用调用处的超时时间
+    # adaptive为None时只调整幂等action的超时时间
+    # hedge_after为None时在等待超过最近p95之后再发一次请求，idempotent为None时根据action名称判断
+    def __init__(self, *, adaptive: bool | None = None, floor: float = 1.0, ceiling: float | None = None,
+                 multiplier: float = 3.0, retries: int = 0, hedge: bool = False, hedge_after: float | None = None,
+                 idempotent: bool | None = None):
+        self.adaptive = adaptive
+        self.floor = floor
+        self.ceiling = ceiling
+        self.multiplier = multiplier
+        self.retries = retries
+        self.hedge = hedge
+        self.hedge_after = hedge_after
+        self.idempotent = idempotent
+
+
+# 超时的调用是删失样本，只知道实际延迟不小于超时时间，所以窗口内有超时的调用时p99至少取超时时间
+# 否则一次延迟突增要等窗口中积累到1%的超时之后超时时间才会增长，期间的调用会接连超时
+class _LatencyWindow:
+    __slots__ = ('samples', 'censored', 'p95', 'p99', '_count', '_dirty')
+
+    def __init__(self, size: int):
+        self.samples: Deque[float] = deque(maxlen=size)
+        self.censored: Deque[Tuple[int, float]] = deque()  # (样本序号, 超时时间)
+        self.p95 = 0.0
+        self.p99 = 0.0
+        self._count = 0
+        self._dirty = 0
+
+    def observe(self, value: float, censored: bool = False) -> None:
+        self.samples.append(value)
+        self._count += 1
+        self._dirty += 1
+        if censored:
+            self.censored.append((self._count, value))
+            self.refresh()  # 超时后立即生效
+        elif self._dirty >= 16:  # 每16次调用重新计算一次分位数，排序的开销分摊到每次调用上可以忽略
+            self.refresh()
+
+    def refresh(self) -> None:
+        ordered = sorted(self.samples)
+        self.p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        self.p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+        while self.censored and self.censored[0][0] <= self._count - len(self.samples):  # 已经移出窗口
+            self.censored.popleft()
+        if self.censored:
+            self.p99 = max(self.p99, max(value for _, value in self.censored))
+        self._dirty = 0
+
+
+class AdaptiveTimeouts:
+    def __init__(self, overrides: Dict[str, ApiPolicy] | None = None, *, default: ApiPolicy | None = None,
+                 window: int = 256, min_samples: int = 20):
+        # 这些调用的耗时与文件大小、群人数或者转发的消息数有关，不适合按之前的延迟估计
+        self.overrides: Dict[str, ApiPolicy] = {action: ApiPolicy(adaptive=False) for action in _size_dependent}
+        self.overrides.update(overrides or {})
+        self.default = default or ApiPolicy()
+        self.window = window
+        self.min_samples = min_samples  # 样本数量不足时使用调用处的超时时间
+
+        self._latency: Dict[str, _LatencyWindow] = {}
+
+        # 统计数据
+        self.retried = 0
+        self.hedged = 0
+        self.hedge_wins = 0  # 重复发送的请求先返回的次数
+
+    def policy(self, action_name: str) -> ApiPolicy:
+        return self.overrides.get(action_name, self.default)
+
+    def _window(self, action_name: str) -> _LatencyWindow:
+        if (window := self._latency.get(action_name)) is None:
+            window = self._latency[action_name] = _LatencyWindow(self.window)
+        return window
+
+    def observe(self, action_name: str, latency: float, censored: bool = False) -> None:
+        self._window(action_name).observe(latency, censored)
+
+    def is_adaptive(self, action_name: str) -> bool:
+        if (adaptive := self.policy(action_name).adaptive) is not None:
+            return adaptive
+        return self.is_idempotent(action_name)
+
+    def timeout(self, action_name: str, default: float) -> float:
+        policy = self.policy(action_name)
+        ceiling = policy.ceiling if policy.ceiling is not None else default
+        window = self._latency.get(action_name)
+        if not self.is_adaptive(action_name) or window is None or len(window.samples) < self.min_samples:
+            return ceiling
+        return min(ceiling, max(policy.floor, window.p99 * policy.multiplier))
+
+    def is_idempotent(self, action_name: str) -> bool:
+        if (idempotent := self.policy(action_name).idempotent) is not None:
+            return idempotent
+        return action_name.startswith(('get_', 'can_', '_get_'))
+
+    def stats(self) -> dict:
+        return {
+            'retried': self.retried,
+            'hedged': self.hedged,
+            'hedge_wins': self.hedge_wins,
+            'actions': {name: {'samples': len(window.samples), 'p95': window.p95, 'p99': window.p99,
+                               'timeout': self.timeout(name, float('inf'))}
+                        for name, window in self._latency.items()},
+        }
+
+    async def call(self, connection, action_name: str, params: dict, default_timeout: float) -> Payload:
+        policy = self.policy(action_name)
+        idempotent = self.is_idempotent(action_name)
+        attempts = policy.retries + 1 if idempotent else 1
+
+        for attempt in range(attempts):
+            timeout = self.timeout(action_name, default_timeout)
+            start = time.perf_counter()
+            try:
+                if idempotent and policy.hedge:
+                    result = await self._hedged(connection, action_name, params, timeout)
+                else:
+                    result = await connection.call(action_name, params, timeout)
+            except ApiTimeout:
+                self.observe(action_name, timeout, censored=True)  # 协议端整体变慢时超时时间随之增长
+                if attempt == attempts - 1:
+                    raise
+                self.retried += 1
+                continue
+            self.observe(action_name, time.perf_counter() - start)
+            return result
+
+    async def _hedged(self, connection, action_name: str, params: dict, timeout: float) -> Payload:
+        policy = self.policy(action_name)
+        if (hedge_after := policy.hedge_after) is None:
+            window = self._latency.get(action_name)
+            if window is None or len(window.samples) < self.min_samples:
+                return await connection.call(action_name, params, timeout)
+            hedge_after = window.p95
+        if hedge_after >= timeout:
+            return await connection.call(action_name, params, timeout)
+
+        tasks = [asyncio.ensure_future(connection.call(action_name, params, timeout))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if not done:
+                self.hedged += 1
+                tasks.append(asyncio.ensure_future(connection.call(action_name, params, timeout - hedge_after)))
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                if succeeded := [task for task in done if task.exception() is None]:
+                    if succeeded[0] is not tasks[0]:
+                        self.hedge_wins += 1
+                    return succeeded[0].result()
+            return tasks[0].result()  # 全部失败时抛出第一次调用的异常
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
@@ -0,0 +1,64 @@
+from . import ApiFailure, _call_onebot_api
+from .send_msg import send_msg
+from .get_msg import get_msg
+from .send_scheduler import Priority
+from .. import Payload
+from ..message import Position, Message, MessageEvent, Text
+from ..bot_context import print_log
+
+import asyncio
+import logging
+
+from typing import Awaitable, Callable, Iterable, List, TypeVar
+
+_T = TypeVar('_T')
+_R = TypeVar('_R')
+
+
+# 批量调用api，同一时间最多有window个调用在等待响应，调用之间不再逐个等待往返
+# 返回结果与输入顺序一致，失败的项为对应的异常对象，不会影响其他项
+# 整个批量调用被取消时直接抛出CancelledError；单个调用被取消（比如被发送限流丢弃或连接关闭）时记为失败，
+# 不确定是否已经发出，所以用ApiFailure而不是ApiNotSent表示
+async def _pipelined(func: Callable[[_T], Awaitable[_R]], items: Iterable[_T], window: int,
+                     name: str) -> List[_R | Exception]:
+    limit = asyncio.Semaphore(window)
+
+    async def run(item: _T) -> _R:
+        async with limit:
+            return await func(item)
+
+    # gather在自身被取消时会抛出CancelledError，不会放进结果中
+    res = await asyncio.gather(*(run(item) for item in items), return_exceptions=True)
+    for i, item in enumerate(res):
+        if isinstance(item, asyncio.CancelledError):
+            res[i] = ApiFailure(f'Call {i} in batch {name} was cancelled.')
+    if failed := sum(isinstance(item, Exception) for item in res):
+        print_log(f'{failed} of {len(res)} calls failed in batch {name}.', logging.WARNING)
+    return res
+
+
+# calls中的每一项为(action, params)
+async def call_batch(calls: Iterable[tuple[str, dict]], *, window: int = 16,
+                     timeout: float = 10) -> List[Payload | None | Exception]:
+    return await _pipelined(lambda call: _call_onebot_api(call[0], call[1], timeout), calls, window, 'call_batch')
+
+
+# 仍然经过bot的发送限流，返回各条消息的id
+async def send_many(items: Iterable[tuple[Position, Message | str]], *, window: int = 8,
+                    priority: int = Priority.NORMAL) -> List[int | Exception]:
+    return await _pipelined(lambda item: send_msg(item[0], item[1], priority=priority), items, window, 'send_many')
+
+
+async def get_msg_many(msg_ids: Iterable[int], *, window: int = 16) -> List[MessageEvent | Exception]:
+    return await _pipelined(get_msg, msg_ids, window, 'get_msg_many')
+
+
+# 向多个位置发送同一条消息，消息对象只构造一次
+async def broadcast(positions: Iterable[Position], message: Message | str, *, window: int = 8,
+                    priority: int = Priority.NORMAL) -> List[int | Exception]:
+    if not isinstance(message, Message):
+        message = Message(Text(message))
+    return await send_many(((position, message) for position in positions), window=window, priority=priority)
+
+
+__all__ = ['call_batch', 'send_many', 'get_msg_many', 'broadcast']
@@ -1,43 +1,35 @@
 # 由于不同版本的协议端获取图片不一定都能正常工作，且为了避免额外的硬盘io开销，手动实现了这个接口
-from urllib.parse import urlparse, parse_qs
+from urllib.parse import urlparse, parse_qs, urlencode
 import aiohttp
 
-import asyncio
-import atexit
+from .image_cache import ImageCache
+from ..http_client import client  # 与插件共用同一个连接池
 
+import tempfile
 
-class HttpClient:
-    def __init__(self):
-        self._session = None  # 创建全局 session
-        atexit.register(self.close_sync)  # 在程序结束时自动关闭
 
-    @property
-    def session(self):
-        if not self._session:
-            self._session = aiohttp.ClientSession(trust_env=True)
-        return self._session
-
-    async def close(self):
-        if not self.session.closed:
-            await self.session.close()
+def parse_url(url: str):
+    parsed = urlparse(url)
+    image_url = f'http://{parsed.netloc}{parsed.path}'
+    query = parse_qs(parsed.query)
+    return image_url, query
 
-    def close_sync(self):
-        """同步调用 close()，确保 session 在 Python 退出前关闭"""
-        loop = asyncio.get_event_loop()
-        if loop.is_running():
-            loop.create_task(self.close())  # 适用于异步环境
-        else:
-            loop.run_until_complete(self.close())  # 适用于同步环境
 
+# 图片下载的缓存，可以替换为自定义参数的对象，设为None则不使用缓存
+image_cache: ImageCache | None = ImageCache()
 
-client = HttpClient()
+# 链接中每次都会变化但不影响图片内容的参数
+_volatile_params = {'rkey', 'term', 'is_origin'}
 
 
-def parse_url(url: str):
+# 同一张图片的链接中rkey等参数可能不同，优先使用fileid作为缓存的key
+def cache_key(url: str) -> str:
     parsed = urlparse(url)
-    image_url = f'http://{parsed.netloc}{parsed.path}'
     query = parse_qs(parsed.query)
-    return image_url, query
+    if file_id := query.get('fileid'):
+        return f'fileid:{file_id[0]}'
+    params = sorted((k, v) for k, values in query.items() if k not in _volatile_params for v in values)
+    return f'{parsed.netloc}{parsed.path}?{urlencode(params)}'
 
 
 headers = {
@@ -46,11 +38,17 @@ headers = {
 }
 
 
-async def get_image(url: str):
+async def get_image(url: str, *, use_cache: bool = True) -> bytes:
+    if use_cache and image_cache is not None:
+        return await image_cache.get(cache_key(url), lambda: _download_image(url))
+    return await _download_image(url)
+
+
+async def _download_image(url: str) -> bytes:
     image_url, query = parse_url(url)
 
     try:
-        async with client.session.get(image_url, params=query, headers=headers) as resp:
+        async with client.get(image_url, params=query, headers=headers) as resp:
             resp.raise_for_status()
             return await resp.read()
     except aiohttp.ClientResponseError as e:
@@ -61,3 +59,41 @@ async def get_image(url: str):
         raise Exception(f"Error downloading file from {image_url}: {e}\nStatus code: {e.status}\nContent: {content}")
     except Exception as e:
         raise Exception(f"An unexpected error occurred while downloading file from {image_url}: {e}")
+
+
+class ImageTooLarge(Exception):
+    pass
+
+
+# 流式下载，不经过缓存，适合较大的图片
+# 数据按块写入临时文件，小于spool_size时保存在内存中，超过后转存到硬盘，超过max_size时中止下载
+# 返回的文件指针位于开头，使用完毕后需要关闭
+async def download_image(url: str, *, max_size: int = 32 * 2 ** 20, spool_size: int = 2 ** 20,
+                         chunk_size: int = 2 ** 16) -> tempfile.SpooledTemporaryFile:
+    image_url, query = parse_url(url)
+    file = tempfile.SpooledTemporaryFile(max_size=spool_size)
+
+    try:
+        async with client.get(image_url, params=query, headers=headers) as resp:
+            resp.raise_for_status()
+            if resp.content_length is not None and resp.content_length > max_size:
+                raise ImageTooLarge(f'图片大小 {resp.content_length} 超过了限制 {max_size}.')
+
+            size = 0
+            async for chunk in resp.content.iter_chunked(chunk_size):
+                size += len(chunk)
+                if size > max_size:
+                    raise ImageTooLarge(f'图片大小超过了限制 {max_size}.')
+                file.write(chunk)
+    except ImageTooLarge:
+        file.close()
+        raise
+    except aiohttp.ClientResponseError as e:
+        file.close()
+        raise Exception(f"Error downloading file from {image_url}: {e}\nStatus code: {e.status}")
+    except Exception as e:
+        file.close()
+        raise Exception(f"An unexpected error occurred while downloading file from {image_url}: {e}")
+
+    file.seek(0)
+    return file
@@ -1,7 +1,12 @@
 from . import _call_onebot_api
 from ..message import MessageEvent
+from ..bot_context import current_bot, current_connection
 
 
+# 先查找bot最近收发的消息，找不到时再调用api
 async def get_msg(msg_id: int) -> MessageEvent:
-    source = await _call_onebot_api('get_msg_async', {'message_id': msg_id}, 5)
+    cache = current_bot.get().message_cache
+    connection = current_connection.get(None)
+    if cache is None or connection is None or (source := cache.get(connection.self_id, msg_id)) is None:
+        source = await _call_onebot_api('get_msg_async', {'message_id': msg_id}, 5)
     return MessageEvent(source)
@@ -0,0 +1,138 @@
+# 图片下载的缓存，按字节数限制容量并以LRU顺序淘汰
+# 同一个key的并发请求只会触发一次下载（single-flight），较大的图片可以选择存放到硬盘上
+import asyncio
+import hashlib
+import os
+
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict
+
+
+class ImageCache:
+    # max_bytes为内存中缓存的总字节数上限
+    # 指定disk_dir后，大于disk_threshold的图片会存放到该目录下，总大小不超过disk_max_bytes
+    def __init__(self, max_bytes: int = 64 * 2 ** 20, *, disk_dir: str | None = None,
+                 disk_max_bytes: int = 512 * 2 ** 20, disk_threshold: int = 2 ** 20):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self.disk_threshold = disk_threshold
+
+        self._memory: OrderedDict[str, bytes] = OrderedDict()
+        self._memory_size = 0
+        self._disk: OrderedDict[str, int] = OrderedDict()  # key -> 文件大小
+        self._disk_size = 0
+        self._inflight: Dict[str, asyncio.Task] = {}
+
+        if disk_dir is not None:
+            os.makedirs(disk_dir, exist_ok=True)
+            for filename in os.listdir(disk_dir):  # 上次运行留下的缓存文件没有索引，直接清理掉
+                if filename.endswith('.img'):
+                    os.remove(os.path.join(disk_dir, filename))
+
+        # 统计数据
+        self.hits = 0
+        self.disk_hits = 0
+        self.shared = 0  # 合并到正在进行的下载中的请求数量
+        self.misses = 0
+        self.bytes_saved = 0  # 因为命中缓存而不需要下载的字节数
+
+    def stats(self) -> dict:
+        requests = self.hits + self.disk_hits + self.shared + self.misses
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'shared': self.shared,
+            'misses': self.misses,
+            'hit_rate': (requests - self.misses) / requests if requests else 0.0,
+            'bytes_saved': self.bytes_saved,
+            'memory_bytes': self._memory_size,
+            'memory_entries': len(self._memory),
+            'disk_bytes': self._disk_size,
+            'disk_entries': len(self._disk),
+        }
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, hashlib.sha1(key.encode()).hexdigest() + '.img')
+
+    async def get(self, key: str, fetch: Callable[[], Awaitable[bytes]]) -> bytes:
+        if (data := self._memory.get(key)) is not None:
+            self._memory.move_to_end(key)
+            self.hits += 1
+            self.bytes_saved += len(data)
+            return data
+
+        if key in self._disk:
+            try:
+                data = await asyncio.to_thread(_read_file, self._disk_path(key))
+            except OSError:  # 缓存文件被外部删除
+                self._disk_size -= self._disk.pop(key)
+            else:
+                self._disk.move_to_end(key)
+                self.disk_hits += 1
+                self.bytes_saved += len(data)
+                return data
+
+        if (task := self._inflight.get(key)) is not None:
+            self.shared += 1
+            data = await asyncio.shield(task)
+            self.bytes_saved += len(data)
+            return data
+
+        self.misses += 1
+        # 下载放在单独的task中进行，发起请求的一方被取消时不影响其他等待同一张图片的请求
+        task = self._inflight[key] = asyncio.create_task(self._fetch(key, fetch))
+        task.add_done_callback(lambda t: t.cancelled() or t.exception())  # 所有等待方都被取消时避免异常无人读取的警告
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key: str, fetch: Callable[[], Awaitable[bytes]]) -> bytes:
+        try:
+            data = await fetch()
+            if self.disk_dir is not None and len(data) > self.disk_threshold:
+                if len(data) <= self.disk_max_bytes:
+                    await asyncio.to_thread(_write_file, self._disk_path(key), data)
+                    self._put_disk(key, len(data))
+            elif len(data) <= self.max_bytes:
+                self._put_memory(key, data)
+            return data
+        finally:
+            del self._inflight[key]
+
+    def _put_memory(self, key: str, data: bytes) -> None:
+        self._memory[key] = data
+        self._memory_size += len(data)
+        while self._memory_size > self.max_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted)
+
+    def _put_disk(self, key: str, size: int) -> None:
+        self._disk[key] = size
+        self._disk_size += size
+        while self._disk_size > self.disk_max_bytes:
+            evicted, evicted_size = self._disk.popitem(last=False)
+            self._disk_size -= evicted_size
+            try:
+                os.remove(self._disk_path(evicted))
+            except OSError:
+                pass
+
+    def clear(self) -> None:
+        self._memory.clear()
+        self._memory_size = 0
+        for key in self._disk:
+            try:
+                os.remove(self._disk_path(key))
+            except OSError:
+                pass
+        self._disk.clear()
+        self._disk_size = 0
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def _write_file(path: str, data: bytes) -> None:
+    with open(path, 'wb') as f:
+        f.write(data)
@@ -0,0 +1,89 @@
+# 最近消息的缓存，按(self_id, message_id)保存消息的原始数据，get_msg命中时不需要调用api
+# 不同账号的message_id由各自的协议端分配，可能重复，所以键中要带上账号
+# 每项只保存编码后的json字节串（接收的消息直接使用收到的原始帧），比保存解码后的dict小一个数量级
+# 条数超过max_entries或总字节数超过max_bytes时按LRU顺序淘汰，超过ttl后失效
+import time
+
+from collections import OrderedDict
+from typing import Tuple
+
+_Key = Tuple[int, int]  # (self_id, message_id)
+
+from .. import Payload, codec
+
+
+class RecentMessageCache:
+    # max_entry_bytes以上的消息不缓存，避免内联了base64图片的发送消息占用大量内存
+    def __init__(self, max_entries: int = 20000, ttl: float = 3600, *, max_bytes: int = 64 * 2 ** 20,
+                 max_entry_bytes: int = 16 * 2 ** 10):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+
+        self._entries: OrderedDict[_Key, Tuple[float, bytes]] = OrderedDict()  # 键 -> (过期时间, json)
+        self._size = 0
+
+        # 统计数据
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evicted = 0
+        self.skipped = 0  # 超过大小限制而没有缓存的消息
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            'entries': len(self._entries),
+            'bytes': self._size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / requests if requests else 0.0,
+            'expired': self.expired,
+            'evicted': self.evicted,
+            'skipped': self.skipped,
+        }
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    # frame为已经编码好的json，可以直接传入收到的帧，避免重新编码
+    def put_frame(self, self_id: int, message_id: int, frame: bytes | str) -> None:
+        if isinstance(frame, str):
+            frame = frame.encode()
+        if len(frame) > self.max_entry_bytes:
+            self.skipped += 1
+            return
+
+        key = (self_id, message_id)
+        if (old := self._entries.pop(key, None)) is not None:
+            self._size -= len(old[1])
+        self._entries[key] = (time.monotonic() + self.ttl, frame)
+        self._size += len(frame)
+        while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+            self.evicted += 1
+
+    def put(self, payload: Payload) -> None:
+        self.put_frame(payload['self_id'], payload['message_id'], codec.codec.dumps(payload))
+
+    def get(self, self_id: int, message_id: int | str) -> Payload | None:
+        key = (self_id, int(message_id))  # 消息段中的id为字符串
+        if (entry := self._entries.get(key)) is None:
+            self.misses += 1
+            return None
+        expires_at, frame = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self._size -= len(frame)
+            self.expired += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return codec.codec.loads(frame)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._size = 0
@@ -0,0 +1,202 @@
+# 发送队列，连接断开时暂存发送消息等api调用，协议端重新连接（收到lifecycle connect事件）后按顺序重新发送
+# 调用方会一直等待到消息被重新发送或者过期，处理函数不会因为连接断开而直接失败
+# 指定path时队列同时写入sqlite数据库，进程重启后未过期的调用会在下次连接时发送（此时已经没有等待结果的调用方）
+# 只有确定没有发出的调用才会进入队列；已经发出但连接在响应前断开的调用无法确认是否送达，为了避免重复发送不会重试
+# 重新连接之后才加入队列的调用（比如断开前开始执行的处理函数）会立即通过新的连接发送，不会等到下次连接
+# 重新发送仍然经过bot的发送限流；数据库的读写都在单独的线程中按顺序执行，不阻塞事件循环
+import asyncio
+import concurrent.futures
+import itertools
+import logging
+import sqlite3
+import time
+
+from collections import deque
+from typing import Deque, Dict, Iterable
+
+from . import ApiFailure, ApiNotSent, ApiTimeout
+from .send_scheduler import Priority
+from .. import Payload, codec
+from ..bot_context import current_bot, print_log
+from ..message import Group, Private, Position
+
+_default_actions = frozenset({'send_msg', 'send_msg_async', 'send_group_msg', 'send_private_msg'})
+
+
+class _Entry:
+    __slots__ = ('seq', 'action', 'params', 'expires_at', 'future', 'dead')
+
+    def __init__(self, seq: int, action: str, params: dict, expires_at: float, future: asyncio.Future | None):
+        self.seq = seq
+        self.action = action
+        self.params = params
+        self.expires_at = expires_at  # 使用墙上时间，重启后仍然有效
+        self.future = future
+        self.dead = False  # 调用方已经不再等待结果，调用仍然会被发送，与进程重启后恢复的调用相同
+
+
+class Outbox:
+    # max_size为所有连接排队的调用总数上限，超出时新的调用直接失败；ttl为每个调用在队列中保留的秒数
+    def __init__(self, *, max_size: int = 1000, ttl: float = 300, path: str | None = None,
+                 actions: Iterable[str] = _default_actions):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.actions = frozenset(actions)
+
+        self._queues: Dict[int, Deque[_Entry]] = {}  # 协议端的qq号 -> 排队的调用
+        self._size = 0
+        self._seq = itertools.count(1)
+        self._replaying: set[int] = set()
+        self._drains: set[asyncio.Task] = set()  # 进行中的重新发送，保留引用以免task被回收
+        self._db: sqlite3.Connection | None = None
+        self._writer: concurrent.futures.ThreadPoolExecutor | None = None  # 单个线程，保证写入顺序
+
+        # 统计数据
+        self.queued = 0
+        self.replayed = 0
+        self.expired = 0
+        self.rejected = 0
+        self.failed = 0
+
+        if path is not None:
+            self._open(path)
+
+    # 在创建时同步读取，之后的写入都交给writer线程
+    def _open(self, path: str) -> None:
+        # 自动提交，每次写入立即落盘
+        self._db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS outbox (seq INTEGER PRIMARY KEY, self_id INTEGER NOT NULL, '
+                         'action TEXT NOT NULL, params TEXT NOT NULL, expires_at REAL NOT NULL)')
+        self._db.execute('DELETE FROM outbox WHERE expires_at < ?', (time.time(),))
+        rows = self._db.execute('SELECT seq, self_id, action, params, expires_at FROM outbox ORDER BY seq').fetchall()
+        for seq, self_id, action, params, expires_at in rows:
+            self._queues.setdefault(self_id, deque()).append(
+                _Entry(seq, action, codec.codec.loads(params), expires_at, None))
+        self._size = len(rows)
+        if rows:
+            self._seq = itertools.count(rows[-1][0] + 1)
+            print_log(f'Restored {len(rows)} queued api calls from {path}.')
+        self._writer = concurrent.futures.ThreadPoolExecutor(1, thread_name_prefix='outbox')
+
+    def _execute(self, sql: str, args: tuple) -> None:
+        try:
+            self._db.execute(sql, args)
+        except sqlite3.Error as e:
+            print_log(f'Failed to write outbox database: {e!r}', logging.ERROR)
+
+    # 写入在writer线程中排队执行，不等待完成；同一个调用的插入一定先于删除
+    def _write(self, sql: str, args: tuple) -> None:
+        if self._writer is not None:
+            self._writer.submit(self._execute, sql, args)
+
+    def _delete(self, entry: _Entry) -> None:
+        self._write('DELETE FROM outbox WHERE seq = ?', (entry.seq,))
+
+    def accepts(self, action_name: str) -> bool:
+        return action_name in self.actions
+
+    def pending(self, self_id: int) -> int:
+        return len(self._queues.get(self_id, ()))
+
+    def stats(self) -> dict:
+        return {
+            'size': self._size,
+            'queued': self.queued,
+            'replayed': self.replayed,
+            'expired': self.expired,
+            'rejected': self.rejected,
+            'failed': self.failed,
+        }
+
+    # 加入队列并等待重新发送的结果，超过ttl时抛出ApiTimeout
+    # connection为该账号当前可用的连接，传入时立即开始（或者由正在进行的重新发送继续）发送队列中的调用
+    async def send(self, self_id: int, action_name: str, params: dict, connection=None) -> Payload:
+        if self._size >= self.max_size:
+            self.rejected += 1
+            raise ApiFailure('发送队列已满，api调用被丢弃.')
+
+        entry = _Entry(next(self._seq), action_name, params, time.time() + self.ttl,
+                       asyncio.get_running_loop().create_future())
+        if self._writer is not None:
+            self._write('INSERT INTO outbox VALUES (?, ?, ?, ?, ?)',
+                        (entry.seq, self_id, action_name, codec.codec.dumps_text(params), entry.expires_at))
+        self._queues.setdefault(self_id, deque()).append(entry)
+        self._size += 1
+        self.queued += 1
+        if connection is not None and not connection.closed:
+            self.drain(connection)
+        else:
+            print_log(lambda: f'Connection {self_id} is down, api call {action_name} queued.', logging.WARNING)
+
+        try:
+            return await asyncio.wait_for(asyncio.shield(entry.future), self.ttl)
+        except asyncio.TimeoutError:
+            raise ApiTimeout(f'API call {action_name} expired in outbox after {self.ttl}s.')
+        finally:
+            entry.dead = not entry.future.done()
+
+    # 在单独的task中重新发送，不经过bot的executor，不受处理函数的队列上限和超时时间限制
+    def drain(self, connection) -> None:
+        if connection.self_id in self._replaying or not self.pending(connection.self_id):
+            return
+        task = asyncio.create_task(self.replay(connection))
+        self._drains.add(task)
+        task.add_done_callback(self._drains.discard)
+
+    # 通过新的连接按顺序重新发送排队的调用，连接再次断开时停止，剩下的调用等待下一次连接
+    # 在bot的上下文中执行，bot启用了发送限流时每个调用都要先取得发送许可，避免重新连接后一次发出大量消息
+    async def replay(self, connection, timeout: float = 12) -> None:
+        self_id = connection.self_id
+        if self_id in self._replaying or not (queue := self._queues.get(self_id)):
+            return
+
+        bot = current_bot.get(None)
+        scheduler = bot.send_scheduler if bot is not None else None
+        self._replaying.add(self_id)
+        count = 0
+        try:
+            while queue:
+                entry = queue[0]
+                if entry.expires_at < time.time():
+                    self.expired += 1
+                else:
+                    try:
+                        if scheduler is not None:
+                            await scheduler.acquire(_position(entry.params), Priority.NORMAL)
+                        result = await connection.call(entry.action, entry.params, timeout)
+                    except ApiNotSent:
+                        break
+                    except Exception as e:  # 被限流丢弃，或者已经发出但无法确认是否送达，不再重试
+                        self.failed += 1
+                        if entry.future is not None and not entry.dead:
+                            entry.future.set_exception(e)
+                    else:
+                        count += 1
+                        self.replayed += 1
+                        if entry.future is not None and not entry.dead:
+                            entry.future.set_result(result)
+                queue.popleft()
+                self._size -= 1
+                self._delete(entry)
+        finally:
+            self._replaying.discard(self_id)
+        if count:
+            print_log(f'Replayed {count} queued api calls on connection {self_id}, {len(queue)} left.')
+
+    def close(self) -> None:
+        for task in self._drains:
+            task.cancel()
+        if self._writer is not None:
+            self._writer.shutdown(wait=True)  # 等待排队的写入完成
+            self._writer = None
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+
+def _position(params: dict) -> Position:
+    if params.get('message_type', 'group' if 'group_id' in params else 'private') == 'group':
+        return Group(params['group_id'])
+    return Private(params['user_id'])
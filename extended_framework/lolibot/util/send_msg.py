@@ -1,33 +1,58 @@
 from . import _call_onebot_api
 from ..message import Position, Message
-from ..bot_context import print_log
+from ..bot_context import current_bot, current_connection, print_log
+from .send_scheduler import Priority
+from ..codec import AsciiBuffer
 
-import asyncio
+import itertools
+import time
 
 
 # 先前为了防止循环引用，send_msg移动至type.py，当前采用的方案是把util各项分开
 # 可能需要调整架构，或者把MessageEvent做二次封装等
 
-# 这个是直接搬过来的
-# 为每次api调用生成序列号，以识别返回结果的对应关系
-class _SequenceGenerator:
-    _seq = -1
-    _lock = asyncio.Lock()
+# 只用于给日志中的消息编号
+_log_seq = itertools.count(1)
 
-    @classmethod
-    async def next(cls) -> int:
-        async with cls._lock:
-            cls._seq = (cls._seq + 1) % 2147483647
-            return cls._seq + 1  # 不能返回0，不然result存储类的add方法会出问题
 
-
-async def send_msg(position: Position, message: Message | str) -> int:
+# priority为发送优先级，发送队列满时低优先级的消息会被丢弃并抛出SendDropped
+async def send_msg(position: Position, message: Message | str, *, priority: int = Priority.NORMAL) -> int:
     content = message.content if isinstance(message, Message) else message
     params = {'message_type': 'group', 'group_id': position.obj_id, 'message': content} if position.is_group \
         else {'message_type': 'private', 'user_id': position.obj_id, 'message': content}
-    temp_id = await _SequenceGenerator.next()
-    print_log(f'Sending Message No.{temp_id} to {position}:\n{message}')
+    if (scheduler := current_bot.get().send_scheduler) is not None:
+        await scheduler.acquire(position, priority)
+    temp_id = next(_log_seq)
+    print_log(lambda: f'Sending Message No.{temp_id} to {position}:\n{message}', hot=True)
     res = await _call_onebot_api('send_msg_async', params, timeout=12)
     msg_id = res['message_id']
-    print_log(f'Message No.{temp_id} sent successfully with real msg_id {msg_id}.')
+    print_log(lambda: f'Message No.{temp_id} sent successfully with real msg_id {msg_id}.', hot=True)
+    # 内联了base64媒体的消息不缓存，避免编码一遍后才发现超过大小限制
+    # 协议端没有告知账号（self_id为0）时无法和收到的消息区分，也不缓存
+    if (cache := current_bot.get().message_cache) is not None and (self_id := current_connection.get().self_id) \
+            and not any(_is_inline(seg) for seg in content):
+        cache.put(_sent_payload(self_id, position, content, msg_id))
     return msg_id
+
+
+def _is_inline(seg) -> bool:
+    if not isinstance(seg, dict):
+        return False
+    file = seg['data'].get('file')
+    return isinstance(file, AsciiBuffer) or isinstance(file, str) and file.startswith('base64://')
+
+
+# 按接收消息的格式构造自己发出的消息，以便之后回复这条消息时get_msg可以直接命中缓存
+def _sent_payload(self_id: int, position: Position, content: list | str, msg_id: int) -> dict:
+    if isinstance(content, str):
+        content = [{'type': 'text', 'data': {'text': content}}]
+    payload = {
+        'self_id': self_id, 'user_id': self_id, 'time': int(time.time()), 'message_id': msg_id,
+        'message': content, 'message_format': 'array', 'post_type': 'message_sent',
+        'sender': {'user_id': self_id, 'nickname': '', 'card': '', 'role': 'member'},
+    }
+    if position.is_group:
+        payload.update(message_type='group', sub_type='normal', group_id=position.obj_id)
+    else:
+        payload.update(message_type='private', sub_type='friend', target_id=position.obj_id)
+    return payload
@@ -0,0 +1,187 @@
+# 发送调度器，位于send_msg与api调用之间
+# 每条消息在真正发送前需要从调度器获取许可，调度器按优先级排队，并用令牌桶限制每个群、每个用户以及全局的发送速率
+# 队列有长度上限，满了之后优先丢弃低优先级的消息
+# 发往同一目标的消息总是按调用顺序发送，高优先级的消息不会越过同一目标之前的消息，而是让排在它前面的消息一起提前
+import asyncio
+import bisect
+import itertools
+import time
+
+from collections import deque
+from enum import IntEnum
+from typing import Deque, Dict, Hashable, List
+
+
+class Priority(IntEnum):  # 数值越小越优先
+    HIGH = 0
+    NORMAL = 1  # 命令回复等
+    LOW = 2  # 复读等可以丢弃的消息
+
+
+class SendDropped(Exception):
+    pass
+
+
+class _TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'stamp')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate  # 每秒补充的令牌数
+        self.capacity = capacity  # 允许的突发数量
+        self.tokens = capacity
+        self.stamp = time.monotonic()
+
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def delay(self) -> float:  # 需要先调用refill，返回还需要等待多久才有令牌
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class _Ticket:
+    __slots__ = ('priority', 'seq', 'target', 'future', 'enqueued')
+
+    def __init__(self, priority: int, seq: int, target: Hashable, future: asyncio.Future):
+        self.priority = priority
+        self.seq = seq
+        self.target = target
+        self.future = future
+        self.enqueued = time.monotonic()
+
+    def __lt__(self, other: '_Ticket'):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class SendScheduler:
+    # 默认值参考了qq的风控，速率的单位是条每秒，burst是允许的突发数量，rate设为None表示不限制
+    def __init__(self, *, group_rate: float | None = 1, group_burst: float = 5,
+                 private_rate: float | None = 1, private_burst: float = 5,
+                 global_rate: float | None = 10, global_burst: float = 20,
+                 max_queue: int = 200):
+        self.group_limit = (group_rate, group_burst)
+        self.private_limit = (private_rate, private_burst)
+        self.max_queue = max_queue
+
+        self._global_bucket = _TokenBucket(global_rate, global_burst) if global_rate else None
+        self._buckets: Dict[Hashable, _TokenBucket] = {}
+        self._queue: List[_Ticket] = []  # 按(优先级, 序号)有序
+        self._targets: Dict[Hashable, Deque[_Ticket]] = {}  # 发送目标 -> 按入队顺序排列的消息
+        self._seq = itertools.count()
+        self._wakeup: asyncio.Event | None = None
+        self._dispatcher: asyncio.Task | None = None
+
+        # 统计数据
+        self.sent = 0
+        self.dropped = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def stats(self) -> dict:
+        return {
+            'depth': self.depth,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'avg_wait': self.total_wait / self.sent if self.sent else 0.0,
+            'max_wait': self.max_wait,
+        }
+
+    def _bucket(self, target: tuple[int, bool]) -> _TokenBucket | None:
+        if (bucket := self._buckets.get(target)) is None:
+            rate, burst = self.group_limit if target[1] else self.private_limit
+            if not rate:
+                return None
+            # 空闲的令牌桶是满的，和新建的没有区别，数量过多时清理掉
+            if len(self._buckets) > 4096:
+                now = time.monotonic()
+                for key, item in list(self._buckets.items()):
+                    item.refill(now)
+                    if item.tokens >= item.capacity:
+                        del self._buckets[key]
+            bucket = self._buckets[target] = _TokenBucket(rate, burst)
+        return bucket
+
+    # 等待发送许可，position为发送目标，被挤出队列时抛出SendDropped
+    async def acquire(self, position: 'Position', priority: int = Priority.NORMAL) -> None:
+        target = (position.obj_id, position.is_group)
+        future = asyncio.get_event_loop().create_future()
+        ticket = _Ticket(priority, next(self._seq), target, future)
+
+        if len(self._queue) >= self.max_queue:
+            # 队列已满，丢弃优先级最低（同优先级中最新）的一条
+            if self._queue[-1] < ticket:
+                self.dropped += 1
+                raise SendDropped(f'发送队列已满，丢弃发往 {position} 的消息.')
+            victim = self._queue.pop()
+            self._unlink(victim)
+            self.dropped += 1
+            victim.future.set_exception(SendDropped('发送队列已满，消息被更高优先级的消息挤出.'))
+
+        bisect.insort(self._queue, ticket)
+        self._targets.setdefault(target, deque()).append(ticket)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        else:
+            self._wakeup.set()
+
+        try:
+            await future
+        except asyncio.CancelledError:
+            if ticket in self._queue:
+                self._queue.remove(ticket)
+                self._unlink(ticket)
+            raise
+
+        wait = time.monotonic() - ticket.enqueued
+        self.sent += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def _unlink(self, ticket: _Ticket) -> None:
+        queue = self._targets[ticket.target]
+        queue.remove(ticket)
+        if not queue:
+            del self._targets[ticket.target]
+
+    async def _dispatch(self) -> None:
+        while self._queue:
+            now = time.monotonic()
+            delay = None
+
+            if (global_bucket := self._global_bucket) is not None:
+                global_bucket.refill(now)
+                delay = global_bucket.delay() or None
+
+            if delay is None:
+                # 按优先级顺序找到第一条目标令牌桶可用的消息，实际发送的是该目标最早入队的消息
+                for ticket in self._queue:
+                    ticket = self._targets[ticket.target][0]
+                    if (bucket := self._bucket(ticket.target)) is not None:
+                        bucket.refill(now)
+                        if wait := bucket.delay():
+                            delay = wait if delay is None else min(delay, wait)
+                            continue
+                        bucket.tokens -= 1
+                    if global_bucket is not None:
+                        global_bucket.tokens -= 1
+                    self._queue.remove(ticket)
+                    self._unlink(ticket)
+                    if not ticket.future.done():
+                        ticket.future.set_result(None)
+                    delay = None
+                    break
+
+            if delay is not None:
+                self._wakeup.clear()
+                try:
+                    # 有新消息入队时提前醒来，新消息可能发往一个有令牌的目标
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+            else:
+                await asyncio.sleep(0)  # 让出事件循环，使被唤醒的发送方可以继续执行
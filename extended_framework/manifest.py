@@ -0,0 +1,117 @@
+# 基于命令清单的插件延迟加载
+# 第一次启动时正常导入全部插件，并把每个插件注册的命令（命令名、别名与权限）连同文件的修改时间、大小或哈希写入清单文件
+# 之后启动时，文件没有变化的插件不会被导入，只根据清单注册占位命令，在其命令第一次被触发并通过权限检查时才导入插件
+# 注意除了注册命令之外还有其他副作用（例如添加消息处理函数）的插件会被识别出来并始终在启动时导入
+# 权限中包含检查函数、可变的set或者LiveIdSet等无法写入清单的内容时，插件同样始终在启动时导入
+import hashlib
+import json
+import logging
+import os
+
+from typing import List, Tuple
+
+from .lolibot import Bot, current_bot, print_log
+from .lolibot.plugin import find_modules, load_plugins, _module_file
+from .command import _LazyCommand, _register_command, _unregister_command, main_name_to_command, Command, \
+    _dump_permission, _load_permission
+
+_MANIFEST_VERSION = 2
+
+
+def _fingerprint(path: str, check: str) -> dict:
+    stat = os.stat(path)
+    res = {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+    if check == 'hash':
+        with open(path, 'rb') as f:
+            res['sha1'] = hashlib.sha1(f.read()).hexdigest()
+    return res
+
+
+def _read_manifest(path: str) -> dict:
+    try:
+        with open(path, encoding='utf-8') as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    return manifest.get('plugins', {}) if manifest.get('version') == _MANIFEST_VERSION else {}
+
+
+def _entry_valid(entry: dict | None, fingerprint: dict, check: str) -> bool:
+    if entry is None or entry.get('eager'):
+        return False
+    if check == 'hash':
+        return entry.get('sha1') == fingerprint['sha1']
+    return entry.get('mtime_ns') == fingerprint['mtime_ns'] and entry.get('size') == fingerprint['size']
+
+
+def _handler_counts(bot: Bot) -> tuple[int, ...]:
+    return (len(bot.handle_msg_funcs), len(bot.handle_wsr_connection_funcs), len(bot.handle_notice_funcs),
+            len(bot.handle_request_funcs))
+
+
+def _import_and_describe(bot: Bot, module_name: str, module_route: str, fingerprint: dict) -> dict:
+    funcs_before = _handler_counts(bot)
+    load_plugins([(module_name, module_route)], warm_imports=False)
+    commands = [{'main_name': command.name, 'aliases': command.cmd, 'permission': _dump_permission(command.permission)}
+                for command in main_name_to_command.values()
+                if isinstance(command, Command) and command.module == module_route]
+    # 没有注册命令、修改了bot处理函数或者权限无法写入清单的插件无法延迟加载
+    eager = not commands or funcs_before != _handler_counts(bot) or \
+        any(item['permission'] is None for item in commands)
+    return {'name': module_name, **fingerprint, 'eager': eager, 'commands': commands}
+
+
+# check为mtime时根据文件的修改时间与大小判断清单是否失效，为hash时根据文件内容的sha1判断
+def load_plugins_lazily(bot: Bot, plugin_routes: List[Tuple[str, str]],
+                        manifest_path: str = 'plugin_manifest.json', *, check: str = 'mtime') -> Bot:
+    manifest = _read_manifest(manifest_path)
+    new_manifest = {}
+    lazy_count = 0
+
+    bot_token = current_bot.set(bot)
+    try:
+        print_log('Waiting for plugins to be loaded with manifest...')
+        for module_name, module_route in plugin_routes:
+            if (path := _module_file(module_route)) is None:
+                load_plugins([(module_name, module_route)], warm_imports=False)  # 交给常规流程报告错误
+                continue
+
+            fingerprint = _fingerprint(path, check)
+            entry = manifest.get(module_route)
+            if _entry_valid(entry, fingerprint, check):
+                registered = []
+                try:
+                    for item in entry['commands']:
+                        _register_command(bot, _LazyCommand(item['main_name'], item['aliases'], module_route,
+                                                            _load_permission(item['permission'])))
+                        registered.append(item['main_name'])
+                except Exception as e:
+                    # 与其他插件的命令冲突时改为直接导入，由导入过程报告具体的错误
+                    print_log(f'Manifest of plugin {module_name} is stale: {e}', logging.WARNING)
+                    for main_name in registered:
+                        _unregister_command(bot, main_name)
+                else:
+                    new_manifest[module_route] = entry
+                    lazy_count += 1
+                    continue
+
+            new_manifest[module_route] = _import_and_describe(bot, module_name, module_route, fingerprint)
+
+        # 多个bot或进程可能共用同一个清单文件，写入前重新读取，只更新本次加载的插件，保留其他插件的条目
+        plugins = _read_manifest(manifest_path)
+        plugins.update(new_manifest)
+        try:
+            with open(manifest_path, 'w', encoding='utf-8') as f:
+                json.dump({'version': _MANIFEST_VERSION, 'plugins': plugins}, f, ensure_ascii=False, indent=2)
+        except OSError:
+            print_log(f'Failed to write plugin manifest {manifest_path}.', logging.WARNING)
+
+        print_log(f'{lazy_count} of {len(plugin_routes)} plugins deferred until first use.')
+    finally:
+        current_bot.reset(bot_token)
+    return bot
+
+
+def load_plugins_lazily_from_folder(bot: Bot, plugin_folder: str, manifest_path: str = 'plugin_manifest.json', *,
+                                    check: str = 'mtime') -> Bot:
+    return load_plugins_lazily(bot, find_modules(plugin_folder), manifest_path, check=check)
@@ -0,0 +1,140 @@
+# 插件的热重载，只替换单个插件注册的命令和处理函数，其他插件以及现有的ws连接、等待中的api调用和expect都不受影响
+# 可以手动调用reload_plugin，也可以使用PluginWatcher轮询插件文件的修改时间，在文件变化时自动重载
+import asyncio
+import importlib
+import logging
+import os
+import sys
+import time
+import traceback
+
+from typing import Dict, List, Tuple
+
+from .lolibot import Bot, Server, current_bot, offload, print_log
+from .lolibot.plugin import find_modules, _module_file
+from .command import _register_command, _unregister_command, bot_to_alias, main_name_to_command
+
+
+def _handler_lists(bot: Bot) -> tuple[list, ...]:
+    return bot.handle_msg_funcs, bot.handle_wsr_connection_funcs, bot.handle_notice_funcs, bot.handle_request_funcs
+
+
+def _detach(bot: Bot, module_route: str) -> tuple[list, list[list]]:
+    # 移除该插件在bot上注册的命令和各类处理函数，返回移除的内容以便回滚，处理函数按_handler_lists的顺序排列
+    own_names = set(bot_to_alias.get(bot, {}).values())
+    commands = [command for name, command in main_name_to_command.items()
+                if name in own_names and command.module == module_route]
+    for command in commands:
+        _unregister_command(bot, command.name)
+
+    removed = []
+    for funcs in _handler_lists(bot):
+        own = [func for func in funcs if getattr(func, '__module__', None) == module_route]
+        funcs[:] = [func for func in funcs if func not in own]
+        removed.append(own)
+    return commands, removed
+
+
+# 卸载插件，之后不会再响应该插件的命令
+def unload_plugin(bot: Bot, module_route: str) -> None:
+    _detach(bot, module_route)
+    sys.modules.pop(module_route, None)
+    offload.recycle(module_route)
+    print_log(f'Unloaded plugin {module_route}.')
+
+
+# 重新导入插件，返回耗时（秒），导入失败时恢复原先的命令和处理函数并返回None
+def reload_plugin(bot: Bot, module_route: str) -> float | None:
+    start = time.perf_counter()
+    bot_token = current_bot.set(bot)
+    try:
+        commands, removed = _detach(bot, module_route)
+        old_module = sys.modules.pop(module_route, None)
+        importlib.invalidate_caches()
+
+        try:
+            importlib.import_module(module_route)
+        except (Exception, SystemExit):
+            print_log(f'Error while reloading plugin {module_route}, keeping the old version:\n'
+                      f'{traceback.format_exc()}', logging.ERROR)
+            # 清理导入到一半时注册的内容，再恢复原先的版本
+            _detach(bot, module_route)
+            if old_module is not None:
+                sys.modules[module_route] = old_module
+            else:
+                sys.modules.pop(module_route, None)
+            for command in commands:
+                _register_command(bot, command)
+            for funcs, own in zip(_handler_lists(bot), removed):
+                funcs.extend(own)
+            return None
+
+        if offload.recycle(module_route):
+            print_log(f'Recycled the offload process pool for plugin {module_route}.', logging.DEBUG)
+        elapsed = time.perf_counter() - start
+        print_log(f'Reloaded plugin {module_route} in {elapsed * 1000:.1f} ms.')
+        return elapsed
+    finally:
+        current_bot.reset(bot_token)
+
+
+class PluginWatcher:
+    def __init__(self, bot: Bot, plugin_folder: str, interval: float = 1.0):
+        self.bot = bot
+        self.plugin_folder = plugin_folder
+        self.interval = interval
+        self._mtimes: Dict[str, Tuple[str, int]] = {}  # 模块路径 -> (文件路径, 修改时间)
+        self._task: asyncio.Task | None = None
+
+    def _scan(self) -> Dict[str, Tuple[str, int]]:
+        res = {}
+        for _, module_route in find_modules(self.plugin_folder):
+            if (path := _module_file(module_route)) is None:
+                continue
+            try:
+                res[module_route] = (path, os.stat(path).st_mtime_ns)
+            except OSError:
+                continue
+        return res
+
+    def check(self) -> List[str]:
+        # 检查一次文件变化并处理，返回发生变化的插件
+        current = self._scan()
+        changed = []
+        for module_route, (path, mtime) in current.items():
+            if (old := self._mtimes.get(module_route)) is None or old[1] != mtime:
+                changed.append(module_route)
+                reload_plugin(self.bot, module_route)
+        for module_route in self._mtimes.keys() - current.keys():
+            changed.append(module_route)
+            bot_token = current_bot.set(self.bot)
+            try:
+                unload_plugin(self.bot, module_route)
+            finally:
+                current_bot.reset(bot_token)
+        self._mtimes = current
+        return changed
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.check()
+            except Exception:
+                print_log(traceback.format_exc(), logging.ERROR)
+
+    async def start(self) -> None:
+        self._mtimes = self._scan()  # 启动时的状态作为基准，已经加载的插件不会被重复导入
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+# 在server运行期间监视插件目录，文件修改后自动重载，新增的文件会被加载，删除的文件会被卸载
+def watch_plugins(server: Server, bot: Bot, plugin_folder: str, interval: float = 1.0) -> PluginWatcher:
+    watcher = PluginWatcher(bot, plugin_folder, interval)
+    server.on_startup(watcher.start).on_shutdown(watcher.stop)
+    return watcher